@@ -8,9 +8,19 @@ import string
 import time
 import smtplib
 from email.message import EmailMessage
-import io
-from inference_sdk import InferenceHTTPClient
 import pandas as pd
+from detection import (
+    MODEL_ID, cached_infer, check_fast_path, fast_path_report, get_fast_path_settings, get_job, job_overdue,
+    get_near_duplicate_index, inference_metrics, init_fast_path_table, init_job_table, is_transient_failure,
+    log_fast_path_audit, get_scan_image, get_scan_overlay, run_batch, save_detection, save_scans,
+    start_tempfile_sweeper, submit_detection_job, get_postprocess_settings, get_setting, init_settings_table,
+    init_shadow_table, init_spool_table, postprocess, rescale_to_frame, set_setting, shadow_report,
+    shadow_supported, spool_scan, spool_stats, start_spool_worker, summarize_predictions, to_frame_coordinates
+)
+from imaging import (
+    TILED_MAX_SIDE, UPLINK_KBPS, PhotoQualityError, check_quality, decode_scan, encode, lesion_severity,
+    archive_extension, archive_mime, sample_video_frames, thumbnail_mime, upload_savings
+)
 
 import streamlit as st
 
@@ -103,12 +113,76 @@ def send_otp_email(receiver_email, otp):
         print("Failed to send OTP:", e)
         return False
 
-def init_client():
-    """Initialize Roboflow client for disease detection"""
-    return InferenceHTTPClient(
-        api_url="https://serverless.roboflow.com",
-        api_key="KajReyLpzYwgJ8fJ8sVd"
-    )
+def get_decoded_scan(uploaded, tiled=False):
+    """Decode an upload once per session and reuse it on every rerun"""
+    upload_id = (getattr(uploaded, "file_id", None) or uploaded.name, tiled)
+    cached = st.session_state.get("decoded_scan")
+    if cached is None or cached[0] != upload_id:
+        if tiled:
+            # Wide shots keep their resolution and the whole frame; tiling does the rest
+            scan = decode_scan(uploaded.getvalue(), max_side=TILED_MAX_SIDE, quality=92, crop=False)
+        else:
+            scan = decode_scan(uploaded.getvalue())
+        # A result on screen belongs to the previous image
+        st.session_state.pop("detect_result", None)
+        # The preview embeds only the small thumbnail, never the full image
+        scan["preview_src"] = f"data:{thumbnail_mime()};base64,{base64.b64encode(scan['thumbnail']).decode()}"
+        # Only the current upload is kept so session memory stays flat
+        st.session_state.decoded_scan = (upload_id, scan)
+        cached = st.session_state.decoded_scan
+    return cached[1]
+
+def show_detection_result(result):
+    """Render the result boxes for one scan"""
+    if result.get("predictions") and result.get("scan_id"):
+        overlay = get_scan_overlay(result["scan_id"])
+        if overlay:
+            st.image(overlay, caption="Detected areas", width=300)
+    
+    severity = result.get("severity")
+    if result.get("predictions") and severity:
+        st.markdown(f"""
+        <div class='result-box'>
+            <h2 style="margin: 0 0 10px 0; color: #2e7d32;">Leaf Area Affected</h2>
+            <span style="font-weight: bold; color: #d32f2f; font-size: 28px;">{severity['percent']:.1f}%</span>
+            <p style="font-size: 14px; margin: 5px 0 0 0;">Share of the visible leaf covered by lesions</p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    if result.get("predictions"):
+        for pred in result["predictions"]:
+            disease = pred["class"]
+            confidence = pred["confidence"] * 100
+            class_area = (severity or {}).get("by_class", {}).get(disease)
+            area_line = (
+                f'<p style="font-size: 14px; margin: 10px 0 0 0;">{class_area:.1f}% of the leaf affected</p>'
+                if class_area is not None else ""
+            )
+            
+            st.markdown(f"""
+            <div class='result-box disease-result'>
+                <h2 style="margin: 0 0 15px 0; color: #2e7d32;">Detection Result</h2>
+                <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px;">
+                    <span style="font-weight: bold; color: #d32f2f; font-size: 28px;">{disease}</span>
+                    <span style="font-weight: bold; color: #2e7d32; font-size: 24px;">{confidence:.1f}%</span>
+                </div>
+                <div class="confidence-bar">
+                    <div class="confidence-fill" style="width: {confidence}%;"></div>
+                </div>
+                {area_line}
+            </div>
+            """, unsafe_allow_html=True)
+    else:
+        st.markdown("""
+        <div class='result-box'>
+            <h2 style="margin: 0 0 15px 0; color: #2e7d32;">Detection Result</h2>
+            <div style="text-align: center; padding: 20px;">
+                <img src="https://cdn-icons-png.flaticon.com/128/5610/5610944.png" width="60">
+                <h2 style="color: #2e7d32; font-size: 28px; margin: 15px 0;">Healthy Rice Plant</h2>
+                <p style="font-size: 16px;">No diseases detected</p>
+            </div>
+        </div>
+        """, unsafe_allow_html=True)
 
 def show_bottom_nav(active_page):
     """Display bottom navigation bar"""
@@ -181,9 +255,68 @@ cursor.execute('''
         FOREIGN KEY (user_id) REFERENCES users (id)
     )
 ''')
+
+# Perceptual hash of the scanned image, used to spot re-shot photos
+try:
+    cursor.execute("ALTER TABLE history ADD COLUMN phash TEXT")
+except sqlite3.OperationalError:
+    # Column already exists
+    pass
+
+# One row per scan; its predictions are the history rows with the same scan_id
+cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scans (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        source TEXT,
+        phash TEXT,
+        prediction_count INTEGER,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+''')
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_scans_user_created ON scans (user_id, created_at)")
+
+try:
+    cursor.execute("ALTER TABLE history ADD COLUMN scan_id INTEGER REFERENCES scans (id)")
+except sqlite3.OperationalError:
+    # Column already exists
+    pass
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_scan ON history (scan_id)")
+
+# Packed predictions with boxes, the scan thumbnail and its cached annotated rendering
+# deferred marks scans analyzed later from the offline spool
+# severity is the percent of leaf area affected by lesions inside the predicted boxes
+for column in ("payload BLOB", "thumbnail BLOB", "overlay BLOB", "deferred INTEGER DEFAULT 0", "severity REAL"):
+    try:
+        cursor.execute(f"ALTER TABLE scans ADD COLUMN {column}")
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+
+# sha256 of the uploaded image in the blob store, shared by every scan of the same file
+try:
+    cursor.execute("ALTER TABLE scans ADD COLUMN image_hash TEXT")
+except sqlite3.OperationalError:
+    # Column already exists
+    pass
+cursor.execute("CREATE INDEX IF NOT EXISTS idx_scans_image_hash ON scans (image_hash)")
 conn.commit()
 conn.close()
 
+# Background detection jobs and runtime settings
+init_job_table()
+init_settings_table()
+init_shadow_table()
+init_spool_table()
+init_fast_path_table()
+
+# Clean up upload tempfiles leaked by older versions of the detect page
+start_tempfile_sweeper()
+
+# Analyze scans that were spooled while the inference endpoint was unreachable
+start_spool_worker()
+
 # ========== SESSION STATE INITIALIZATION ==========
 if "user_id" not in st.session_state:
     st.session_state.user_id = None
@@ -711,7 +844,7 @@ elif st.session_state.page == "admin_dashboard":
     
     st.markdown("<br>", unsafe_allow_html=True)
     
-    tab1, tab2, tab3 = st.tabs(["Users", "Detection History", "Settings"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Users", "Detection History", "Settings", "Performance"])
     
     with tab1:
         st.write("**Registered Users**")
@@ -724,7 +857,7 @@ elif st.session_state.page == "admin_dashboard":
         st.write("**Recent Detection History**")
         conn = sqlite3.connect("users.db")
         history_df = pd.read_sql_query("""
-            SELECT h.id, u.username, h.result, h.confidence, h.created_at 
+            SELECT h.id, h.scan_id, u.username, h.result, h.confidence, h.created_at 
             FROM history h 
             JOIN users u ON h.user_id = u.id 
             ORDER BY h.created_at DESC 
@@ -732,10 +865,216 @@ elif st.session_state.page == "admin_dashboard":
         """, conn)
         conn.close()
         st.dataframe(history_df, use_container_width=True)
+        
+        scan_ids = [int(scan_id) for scan_id in history_df["scan_id"].dropna().unique()]
+        if scan_ids:
+            chosen_scan = st.selectbox("View detections for scan", scan_ids, key="admin_scan")
+            overlay = get_scan_overlay(chosen_scan)
+            if overlay:
+                st.image(overlay, width=320)
+            else:
+                st.caption("No image was kept for this scan.")
     
     with tab3:
         st.write("**System Settings**")
-        st.info("Settings panel coming soon...")
+        
+        st.markdown("##### Detection filtering")
+        st.caption("Applied to every scan before it is shown and saved to history.")
+        pp = get_postprocess_settings()
+        
+        min_confidence = st.slider(
+            "Minimum confidence (%)", 0, 100, int(pp["min_confidence"] * 100), key="pp_min_conf"
+        )
+        top_k = st.number_input(
+            "Keep at most this many detections per scan (0 = no limit)",
+            min_value=0, max_value=100, value=int(pp["top_k"]), key="pp_top_k"
+        )
+        collapse = st.checkbox(
+            "Show each disease only once per scan (keep its highest confidence)",
+            value=pp["collapse_duplicates"], key="pp_collapse"
+        )
+        
+        st.write("Per-disease minimum confidence (%)")
+        thresholds_df = st.data_editor(
+            pd.DataFrame(
+                [{"Disease": name, "Minimum confidence": value * 100} for name, value in pp["class_thresholds"].items()],
+                columns=["Disease", "Minimum confidence"]
+            ),
+            num_rows="dynamic", use_container_width=True, key="pp_thresholds"
+        )
+        
+        if st.button("Save Settings", key="save_pp_settings", type="primary"):
+            class_thresholds = {
+                str(row["Disease"]).strip(): float(row["Minimum confidence"]) / 100
+                for _, row in thresholds_df.iterrows()
+                if pd.notna(row["Disease"]) and str(row["Disease"]).strip() and pd.notna(row["Minimum confidence"])
+            }
+            set_setting("postprocess", {
+                "min_confidence": min_confidence / 100,
+                "top_k": int(top_k),
+                "class_thresholds": class_thresholds,
+                "collapse_duplicates": collapse,
+            })
+            st.success("Settings saved.")
+        
+        st.markdown("##### Shadow model evaluation")
+        st.caption(
+            "A sampled share of real scans is also sent to a candidate model in the background. "
+            "Farmers only ever see the primary model's answer."
+        )
+        shadow = get_setting("shadow", {"model_id": "", "sample_rate": 0.0})
+        shadow_off = not shadow_supported()
+        if shadow_off:
+            st.info(
+                "The local backend always runs its bundled model and ignores the model ID, so shadow "
+                "comparisons are off. Switch PALAY_BACKEND to roboflow or sdk to use them."
+            )
+        shadow_model = st.text_input(
+            "Candidate model ID (leave empty to turn off)", value=shadow["model_id"],
+            placeholder="palayprotector-project/2", key="shadow_model", disabled=shadow_off
+        )
+        shadow_rate = st.slider(
+            "Share of scans to compare (%)", 0, 100, int(shadow["sample_rate"] * 100), key="shadow_rate",
+            disabled=shadow_off
+        )
+        if st.button("Save Shadow Settings", key="save_shadow_settings", disabled=shadow_off):
+            set_setting("shadow", {"model_id": shadow_model.strip(), "sample_rate": shadow_rate / 100})
+            st.success("Shadow settings saved.")
+        
+        st.markdown("##### Healthy leaf fast path")
+        st.caption(
+            "A quick on-server colour check answers \"Healthy\" for clearly healthy leaves without calling "
+            "the detection model. A sampled share of scans is still checked by the model to calibrate it."
+        )
+        fast_path = get_fast_path_settings()
+        calibration = fast_path_report()
+        if calibration["recommended"] is not None:
+            st.info(f"Calibrated threshold: {calibration['recommended'] * 100:.0f}% "
+                    f"(from {calibration['samples']} audited scans).")
+        else:
+            st.info(f"Not calibrated yet ({calibration['samples']} audited scans so far).")
+        fast_path_enabled = st.checkbox("Answer clearly healthy leaves locally", value=fast_path["enabled"],
+                                        key="fast_path_enabled")
+        fast_path_threshold = st.slider(
+            "Minimum healthy score to skip the model (%)", 50, 99, int(fast_path["threshold"] * 100),
+            key="fast_path_threshold"
+        )
+        fast_path_audit = st.slider(
+            "Share of scans checked by the model anyway (%)", 0, 100, int(fast_path["audit_rate"] * 100),
+            key="fast_path_audit"
+        )
+        if st.button("Save Fast Path Settings", key="save_fast_path_settings"):
+            set_setting("fast_path", {
+                "enabled": fast_path_enabled,
+                "threshold": fast_path_threshold / 100,
+                "audit_rate": fast_path_audit / 100,
+            })
+            st.success("Fast path settings saved.")
+    
+    with tab4:
+        st.write("**Inference Performance** (since the server started)")
+        metrics = inference_metrics()
+        cache_stats = metrics.pop("cache")
+        singleflight_stats = metrics.pop("singleflight")
+        blob_stats = metrics.pop("blobs")
+        fast_path_stats = metrics.pop("fast_path")
+        
+        for backend_name, stats in metrics.items():
+            st.caption(f"Backend: {backend_name} - circuit breaker {stats['breaker_state'].replace('_', '-')}")
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Calls", stats["calls"])
+            col2.metric("Failures", stats["failures"])
+            col3.metric("Retries", stats["retries"])
+            col4.metric("Timeouts", stats["timeouts"])
+            
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("p50", f"{stats['p50']:.2f}s" if stats["p50"] is not None else "-")
+            col2.metric("p95", f"{stats['p95']:.2f}s" if stats["p95"] is not None else "-")
+            col3.metric("p99", f"{stats['p99']:.2f}s" if stats["p99"] is not None else "-")
+            col4.metric("Breaker trips", stats["breaker_trips"])
+            
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Fast-failed", stats["breaker_rejections"])
+            col2.metric("Hedges sent", stats["hedges_sent"])
+            col3.metric("Hedges won", stats["hedges_won"])
+            col4.metric("Successes", stats["successes"])
+        
+        if not metrics:
+            st.info("No inference calls yet.")
+        
+        st.caption("Result cache")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Memory hits", cache_stats["memory_hits"])
+        col2.metric("Disk hits", cache_stats["disk_hits"])
+        col3.metric("Misses", cache_stats["misses"])
+        col4.metric("Hit rate", f"{cache_stats['hit_rate'] * 100:.0f}%")
+        if cache_stats["errors"]:
+            st.caption(f"{cache_stats['errors']} cache reads or writes skipped because the database was busy")
+        
+        st.caption("Identical concurrent requests")
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Upstream calls", singleflight_stats["leaders"])
+        col2.metric("Coalesced", singleflight_stats["coalesced"])
+        col3.metric("In flight", singleflight_stats["in_flight"])
+        
+        st.caption("Scan image archive")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Images", blob_stats["images"])
+        col2.metric("Stored", f"{blob_stats['bytes'] / 2**20:.0f} / {blob_stats['budget'] / 2**20:.0f} MB")
+        col3.metric("Duplicates skipped", blob_stats["deduplicated"])
+        col4.metric("Collected", blob_stats["collected"])
+        
+        st.caption("Healthy leaf fast path")
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Checked", fast_path_stats["checked"])
+        col2.metric("Answered locally", fast_path_stats["skipped"])
+        col3.metric("Audited", fast_path_stats["audited"])
+        calibration = fast_path_report()
+        if calibration["thresholds"]:
+            st.dataframe(pd.DataFrame([
+                {
+                    "Threshold": f"{row['threshold'] * 100:.0f}%",
+                    "Would skip": row["skipped"],
+                    "Coverage": f"{row['coverage'] * 100:.1f}%",
+                    "Model agrees": f"{row['agreement'] * 100:.1f}%" if row["agreement"] is not None else "-",
+                    "Missed disease": row["missed_disease"],
+                }
+                for row in calibration["thresholds"]
+            ]), use_container_width=True, hide_index=True)
+        
+        st.caption("Offline spool")
+        spooled = spool_stats()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Waiting", spooled.get("queued", 0))
+        col2.metric("Draining", spooled.get("running", 0))
+        col3.metric("Gave up", spooled.get("failed", 0))
+        
+        st.caption("Shadow model comparison")
+        report = shadow_report()
+        if report:
+            def seconds(value):
+                return f"{value:.2f}s" if value is not None else "-"
+            
+            def share(value):
+                return f"{value * 100:.1f}%" if value is not None else "-"
+            
+            st.dataframe(pd.DataFrame([
+                {
+                    "Candidate": candidate,
+                    "Primary": entry["primary_model"],
+                    "Samples": entry["samples"],
+                    "Errors": entry["errors"],
+                    "Top label agreement": share(entry["top_label_agreement"]),
+                    "Label overlap": share(entry["mean_label_jaccard"]),
+                    "Primary p50": seconds(entry["primary_p50"]),
+                    "Candidate p50": seconds(entry["shadow_p50"]),
+                    "Primary p95": seconds(entry["primary_p95"]),
+                    "Candidate p95": seconds(entry["shadow_p95"]),
+                }
+                for candidate, entry in report.items()
+            ]), use_container_width=True, hide_index=True)
+        else:
+            st.info("No shadow comparisons yet. Set a candidate model in Settings.")
     
     if st.button("Logout", key="admin_logout"):
         st.session_state.user_id = None
@@ -2680,19 +3019,20 @@ elif st.session_state.page == "detect":
         image_to_use = camera_photo
         image_source = "camera"
 
+    tiled_mode = st.checkbox(
+        "Wide field shot (analyze in tiles to catch small lesions)", key="tiled_mode"
+    )
+    
     # Display preview
     if image_to_use is not None:
-        image = Image.open(image_to_use)
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+        scan = get_decoded_scan(image_to_use, tiled=tiled_mode)
 
         st.markdown(f"""
         <div class="upload-section">
             <img src="https://cdn-icons-png.flaticon.com/128/2659/2659360.png" width="50" style="margin-bottom: 15px;">
             <div class="upload-text">Image Preview</div>
             <div class="upload-subtext">Ready for analysis</div>
-            <img src="data:image/png;base64,{img_str}" class="preview-image" width="300">
+            <img src="{scan['preview_src']}" class="preview-image" width="300">
         </div>
         """, unsafe_allow_html=True)
     else:
@@ -2706,59 +3046,290 @@ elif st.session_state.page == "detect":
  
     # Detect button
     if st.button("DETECT DISEASE", key="detect_btn", use_container_width=True, type="primary"):
+        st.session_state.pop("detect_result", None)
         if image_to_use is None:
             st.error("Please upload an image or take a photo first.")
+        elif not scan["quality_ok"]:
+            # Rejected before any network call, so junk photos cost nothing
+            st.warning(scan["quality_reason"])
         else:
-            with st.spinner("Analyzing image..."):
-                try:
-                    import tempfile
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-                        image.save(tmp_file, format="JPEG")
-                        tmp_file_path = tmp_file.name
-                    
-                    client = init_client()
-                    result = client.infer(tmp_file_path, model_id="palayprotector-project/1")
-                    
-                    if result.get("predictions"):
-                        for pred in result["predictions"]:
-                            disease = pred["class"]
-                            confidence = pred["confidence"] * 100
-                            
-                            st.markdown(f"""
-                            <div class='result-box disease-result'>
-                                <h2 style="margin: 0 0 15px 0; color: #2e7d32;">Detection Result</h2>
-                                <div style="display: flex; justify-content: space-between; align-items: center; margin-bottom: 15px;">
-                                    <span style="font-weight: bold; color: #d32f2f; font-size: 28px;">{disease}</span>
-                                    <span style="font-weight: bold; color: #2e7d32; font-size: 24px;">{confidence:.1f}%</span>
-                                </div>
-                                <div class="confidence-bar">
-                                    <div class="confidence-fill" style="width: {confidence}%;"></div>
-                                </div>
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            conn = sqlite3.connect("users.db")
-                            cursor = conn.cursor()
-                            cursor.execute("""
-                                INSERT INTO history (user_id, result, confidence)
-                                VALUES (?, ?, ?)
-                            """, (st.session_state.user_id, disease, confidence))
-                            conn.commit()
-                            conn.close()
+            try:
+                result, fast_result, fast_path = None, None, None
+                # Wide canopy shots must always be tiled, and hold too many leaves for the fast path
+                if not tiled_mode:
+                    # A re-shot photo of the same leaf reuses the earlier prediction
+                    result = get_near_duplicate_index().lookup(
+                        st.session_state.user_id, scan["phash"], scan["thumbnail"]
+                    )
+                    if result is None:
+                        fast_result, fast_path = check_fast_path(scan["health"], scan["size"])
+
+                if result is not None:
+                    # Boxes are in the earlier scan's frame; bring them into this one
+                    result = rescale_to_frame(result, scan["size"])
+                    if result["predictions"]:
+                        # Same leaf, new photo: measure lesion area on this one
+                        result["severity"] = lesion_severity(scan["pixels"], result["predictions"])
+                    result["scan_id"] = save_detection(
+                        st.session_state.user_id, scan["phash"], result, thumbnail=scan["thumbnail"],
+                        image=image_to_use.getvalue()
+                    )
+                    st.session_state.detect_result = {
+                        "result": result,
+                        "notes": ["Same leaf scanned moments ago - showing that result."],
+                    }
+                elif fast_result is not None:
+                    get_near_duplicate_index().add(
+                        st.session_state.user_id, scan["phash"], fast_result, scan["thumbnail"]
+                    )
+                    fast_result["scan_id"] = save_detection(
+                        st.session_state.user_id, scan["phash"], fast_result, source="fast_path",
+                        thumbnail=scan["thumbnail"], image=image_to_use.getvalue()
+                    )
+                    st.session_state.detect_result = {
+                        "result": fast_result,
+                        "notes": [f"Quick check: this leaf looks clearly healthy "
+                                  f"({fast_result['fast_path'] * 100:.0f}% score), so no full analysis was needed."],
+                    }
+                else:
+                    notes = []
+                    if scan["roi"]:
+                        left, top, right, bottom = scan["roi"]
+                        frame_share = (right - left) * (bottom - top) / (scan["size"][0] * scan["size"][1])
+                        notes.append(f"Cropped to the leaf area ({frame_share * 100:.0f}% of the photo).")
+                    bytes_saved, seconds_saved = upload_savings(scan)
+                    if bytes_saved:
+                        notes.append(
+                            f"Upload optimized: {scan['original_bytes'] / 1024:.0f} KB → "
+                            f"{scan['upload_bytes'] / 1024:.0f} KB "
+                            f"({bytes_saved / 1024:.0f} KB saved, about {seconds_saved:.1f}s faster "
+                            f"at {UPLINK_KBPS:.0f} kbps)"
+                        )
+                    # Inference runs on the background worker pool; the page polls for the result
+                    st.session_state.detect_job = {
+                        "id": submit_detection_job(
+                            st.session_state.user_id, scan["upload"], scan["phash"], tiled=tiled_mode,
+                            frame={
+                                "offset": scan["roi"][:2] if scan["roi"] else (0, 0),
+                                "size": scan["size"],
+                                "thumbnail": scan["thumbnail"],
+                                "image": image_to_use.getvalue(),
+                                "fast_path": fast_path,
+                            }
+                        ),
+                        "notes": notes,
+                    }
+            except Exception as e:
+                st.error(f"Error during detection: {str(e)}")
+
+    # Pick up a finished background job, even if the user navigated away meanwhile
+    if st.session_state.get("detect_job"):
+        job = get_job(st.session_state.detect_job["id"])
+        overdue = job is not None and job_overdue(job)
+        if job is None or overdue or job["status"] in ("done", "failed", "deferred"):
+            if job is None:
+                error = "Detection job was lost."
+            elif overdue:
+                error = ("Detection is taking far longer than it should and was stopped waiting for. "
+                         "If it still finishes, the result will appear in your History.")
+            else:
+                error = job["error"]
+            st.session_state.detect_result = {
+                "result": job["result"] if job and not overdue else None,
+                "error": error,
+                "deferred": job is not None and job["status"] == "deferred",
+                "notes": st.session_state.detect_job["notes"],
+            }
+            del st.session_state.detect_job
+        else:
+            @st.fragment(run_every=1.5)
+            def poll_detect_job():
+                job = get_job(st.session_state.detect_job["id"])
+                if job is None or job_overdue(job) or job["status"] in ("done", "failed", "deferred"):
+                    st.rerun()
+                label = "Waiting for a free worker..." if job["status"] == "queued" else "Analyzing image..."
+                st.info(label)
+
+            poll_detect_job()
+
+    if st.session_state.get("detect_result"):
+        detect_result = st.session_state.detect_result
+        for note in detect_result["notes"]:
+            st.caption(note)
+        if detect_result.get("deferred"):
+            st.info(
+                "📡 The detection service can't be reached right now. Your photo is saved and will be "
+                "analyzed automatically once it is back; the result will appear in your History."
+            )
+        elif detect_result.get("error"):
+            st.error(f"Error during detection: {detect_result['error']}")
+        else:
+            show_detection_result(detect_result["result"])
+
+    # Batch mode for a whole field walk
+    with st.expander("Scan many images at once"):
+        batch_files = st.file_uploader(
+            "Choose images", type=["jpg", "jpeg", "png"],
+            accept_multiple_files=True, key="batch_upload"
+        )
+
+        if st.button("DETECT ALL", key="detect_all_btn", use_container_width=True):
+            if not batch_files:
+                st.error("Please choose at least one image first.")
+            else:
+                user_id = st.session_state.user_id
+
+                def scan_file(data):
+                    scan = decode_scan(data)
+                    if not scan["quality_ok"]:
+                        raise PhotoQualityError(scan["quality_reason"])
+                    result, fast_path = check_fast_path(scan["health"], scan["size"])
+                    if result is not None:
+                        return {
+                            "phash": scan["phash"], "result": result, "source": "fast_path",
+                            "thumbnail": scan["thumbnail"], "image": data,
+                        }
+                    offset = scan["roi"][:2] if scan["roi"] else (0, 0)
+                    try:
+                        result = cached_infer(scan["upload"], model_id=MODEL_ID)
+                    except Exception as e:
+                        if not is_transient_failure(e):
+                            raise
+                        # Service unreachable: keep the photo and analyze it once it is back
+                        spool_scan(user_id, scan["upload"], scan["phash"], MODEL_ID, False, {
+                            "offset": offset, "size": scan["size"], "thumbnail": scan["thumbnail"],
+                            "image": data, "fast_path": fast_path, "source": "batch",
+                        }, str(e))
+                        return {"deferred": True}
+                    result = postprocess(to_frame_coordinates(result, offset, scan["size"]))
+                    if fast_path["audit"]:
+                        log_fast_path_audit(fast_path, result, MODEL_ID)
+                    if result["predictions"]:
+                        result["severity"] = lesion_severity(scan["pixels"], result["predictions"])
+                    return {
+                        "phash": scan["phash"], "result": result, "source": "batch",
+                        "thumbnail": scan["thumbnail"], "image": data,
+                    }
+
+                progress = st.progress(0.0, text="Analyzing images...")
+                batch_scans = []
+                for done, (index, value, error) in enumerate(
+                    run_batch(scan_file, [f.getvalue() for f in batch_files]), start=1
+                ):
+                    name = batch_files[index].name
+                    if isinstance(error, PhotoQualityError):
+                        st.warning(f"{name}: {error}")
+                    elif error is not None:
+                        st.error(f"{name}: {error}")
+                    elif value.get("deferred"):
+                        st.markdown(
+                            f"**{name}** - <span style='color:#f57c00;'>Saved; it will be analyzed when the "
+                            f"detection service is back and appear in your History</span>", unsafe_allow_html=True
+                        )
                     else:
-                        st.markdown("""
-                        <div class='result-box'>
-                            <h2 style="margin: 0 0 15px 0; color: #2e7d32;">Detection Result</h2>
-                            <div style="text-align: center; padding: 20px;">
-                                <img src="https://cdn-icons-png.flaticon.com/128/5610/5610944.png" width="60">
-                                <h2 style="color: #2e7d32; font-size: 28px; margin: 15px 0;">Healthy Rice Plant</h2>
-                                <p style="font-size: 16px;">No diseases detected</p>
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    
-                except Exception as e:
-                    st.error(f"Error during detection: {str(e)}")
+                        batch_scans.append(value)
+                        result = value["result"]
+                        predictions = result.get("predictions") or []
+                        if predictions:
+                            labels = ", ".join(f"{p['class']} ({p['confidence'] * 100:.1f}%)" for p in predictions)
+                            if result.get("severity"):
+                                labels += f" - {result['severity']['percent']:.1f}% of leaf affected"
+                            st.markdown(f"**{name}** - <span style='color:#d32f2f;'>{labels}</span>", unsafe_allow_html=True)
+                        else:
+                            st.markdown(f"**{name}** - <span style='color:#2e7d32;'>Healthy</span>", unsafe_allow_html=True)
+                    progress.progress(done / len(batch_files), text=f"Analyzed {done} of {len(batch_files)}")
+
+                # One transaction for the whole batch
+                if batch_scans:
+                    save_scans(st.session_state.user_id, batch_scans)
+
+    # Video mode: walk the field while recording, get one summary
+    with st.expander("Scan a field walk video"):
+        video_file = st.file_uploader(
+            "Choose a video", type=["mp4", "mov", "avi", "mkv", "3gp"], key="video_upload"
+        )
+        sampling = st.radio(
+            "Take frames", ["Every second", "When the camera moves"], horizontal=True, key="video_sampling"
+        )
+
+        if st.button("ANALYZE VIDEO", key="analyze_video_btn", use_container_width=True):
+            if video_file is None:
+                st.error("Please choose a video first.")
+            else:
+                import os
+                import tempfile
+                # OpenCV can only stream from a path; the file is removed as soon as sampling ends
+                suffix = os.path.splitext(video_file.name)[1] or ".mp4"
+                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+                    tmp_file.write(video_file.getvalue())
+                    video_path = tmp_file.name
+
+                frames = []
+                skipped = 0
+                video_stats = {}
+                try:
+                    with st.spinner("Reading video..."):
+                        for seconds, pixels, frame_hash in sample_video_frames(
+                            video_path, motion=(sampling == "When the camera moves"), stats=video_stats
+                        ):
+                            if not check_quality(pixels)[0]:
+                                skipped += 1
+                                continue
+                            frames.append((seconds, encode(Image.fromarray(pixels))))
+                except ValueError as e:
+                    st.error(str(e))
+                finally:
+                    os.remove(video_path)
+
+                if video_stats.get("truncated"):
+                    duration = video_stats["duration"]
+                    st.warning(
+                        f"Frame limit reached: only the first {video_stats['covered']:.0f}s"
+                        + (f" of this {duration:.0f}s video" if duration else " of this video")
+                        + " were analyzed, so the frame shares below describe only that part of the walk."
+                    )
+
+                if frames:
+                    progress = st.progress(0.0, text="Analyzing frames...")
+                    frame_results = []
+                    for done, (index, result, error) in enumerate(
+                        run_batch(lambda frame: cached_infer(frame[1], model_id=MODEL_ID), frames),
+                        start=1
+                    ):
+                        if error is None:
+                            frame_results.append(postprocess(result))
+                        progress.progress(done / len(frames), text=f"Analyzed {done} of {len(frames)} frames")
+
+                    st.caption(
+                        f"{len(frames)} distinct frames analyzed"
+                        + (f", {skipped} blurry or badly lit frames skipped" if skipped else "")
+                        + (f", {len(frames) - len(frame_results)} failed" if len(frame_results) < len(frames) else "")
+                    )
+                    summary = summarize_predictions(frame_results)
+                    if summary:
+                        summary_df = pd.DataFrame([
+                            {
+                                "Disease": disease,
+                                "Frames": entry["scans"],
+                                "Share of frames": f"{entry['scans'] / len(frame_results) * 100:.0f}%",
+                                "Best confidence": f"{entry['max_confidence'] * 100:.1f}%",
+                                "Average confidence": f"{entry['mean_confidence'] * 100:.1f}%",
+                            }
+                            for disease, entry in sorted(summary.items(), key=lambda item: -item[1]["scans"])
+                        ])
+                        st.dataframe(summary_df, use_container_width=True, hide_index=True)
+
+                        # One history row per disease found on the walk
+                        save_detection(st.session_state.user_id, None, {"predictions": [
+                            {"class": disease, "confidence": entry["max_confidence"]}
+                            for disease, entry in summary.items()
+                        ]}, source="video")
+                    elif frame_results:
+                        st.success("No diseases detected along this walk.")
+                elif not skipped:
+                    st.warning("No usable frames were found in this video.")
+                else:
+                    st.warning("Every frame was blurry or badly lit. Please walk more slowly and try again.")
     
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -2783,14 +3354,21 @@ elif st.session_state.page == "history":
         conn = sqlite3.connect("users.db")
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT created_at, result, confidence
-            FROM history
-            WHERE user_id = ?
-            ORDER BY created_at DESC
+            SELECT h.created_at, h.result, h.confidence, COALESCE(s.deferred, 0), s.severity
+            FROM history h
+            LEFT JOIN scans s ON s.id = h.scan_id
+            WHERE h.user_id = ?
+            ORDER BY h.created_at DESC
         """, (st.session_state.user_id,))
         rows = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM spool_queue WHERE user_id = ? AND status != 'failed'",
+                       (st.session_state.user_id,))
+        pending_scans = cursor.fetchone()[0]
         conn.close()
 
+        if pending_scans:
+            st.info(f"📡 {pending_scans} scan(s) taken offline are waiting for the detection service.")
+
         if rows:
             from datetime import datetime
 
@@ -2840,11 +3418,12 @@ elif st.session_state.page == "history":
                     <th>Date</th>
                     <th>Disease</th>
                     <th>Confidence</th>
+                    <th>Leaf Affected</th>
                     <th>Action</th>
                 </tr>
             """
 
-            for date, disease, conf in rows:
+            for date, disease, conf, deferred, severity in rows:
                 try:
                     d_obj = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
                     f_date = d_obj.strftime("%Y-%m-%d")
@@ -2854,8 +3433,9 @@ elif st.session_state.page == "history":
                 table_html += f"""
                 <tr>
                     <td>{f_date}</td>
-                    <td>{disease}</td>
+                    <td>{disease}{" (analyzed later)" if deferred else ""}</td>
                     <td>{conf:.2f}%</td>
+                    <td>{f"{severity:.1f}%" if severity is not None else "-"}</td>
                     <td><a href="https://collab-app.com/dashboard?disease={disease}" 
                            target="_blank" class="remedy-btn">View Remedy</a></td>
                 </tr>
@@ -2865,6 +3445,38 @@ elif st.session_state.page == "history":
 
             st.components.v1.html(table_html, height=400, scrolling=True)
 
+            # Saved detections can be shown again without re-running inference
+            conn = sqlite3.connect("users.db")
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT s.id, s.created_at, GROUP_CONCAT(h.result, ', ')
+                FROM scans s
+                LEFT JOIN history h ON h.scan_id = s.id
+                WHERE s.user_id = ? AND (s.thumbnail IS NOT NULL OR s.image_hash IS NOT NULL)
+                  AND s.prediction_count > 0
+                GROUP BY s.id
+                ORDER BY s.created_at DESC
+                LIMIT 30
+            """, (st.session_state.user_id,))
+            viewable_scans = cursor.fetchall()
+            conn.close()
+
+            if viewable_scans:
+                scan_labels = {scan_id: f"{created_at} - {diseases}" for scan_id, created_at, diseases in viewable_scans}
+                chosen_scan = st.selectbox(
+                    "View detections of a scan", list(scan_labels), format_func=scan_labels.get, key="history_scan"
+                )
+                overlay = get_scan_overlay(chosen_scan)
+                if overlay:
+                    st.image(overlay, width=320)
+                original, original_format = get_scan_image(chosen_scan)
+                if original:
+                    st.download_button(
+                        "Download original photo", original,
+                        file_name=f"scan-{chosen_scan}.{archive_extension(original_format)}",
+                        mime=archive_mime(original_format), key="history_scan_download"
+                    )
+
         else:
             st.info("No history records yet.")
 
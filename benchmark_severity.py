@@ -0,0 +1,96 @@
+# ========== SEVERITY MICRO-BENCHMARK ==========
+# Times the lesion-area severity stage on a synthetic diseased leaf, to check
+# it stays well inside its per-scan budget on CPU.
+#
+#   python benchmark_severity.py --side 1024 --boxes 5 --runs 200 --budget-ms 50
+#
+# Two paths are timed: lesion_severity on already decoded pixels (batch and
+# near-duplicate scans) and upload_severity on the JPEG payload, which also
+# pays for decoding (background detection jobs). Exits non-zero when the p95
+# of either path is over budget.
+
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from imaging import encode, lesion_severity, upload_severity
+
+
+def synthetic_leaf(side, boxes, seed):
+    """A leaf on soil with brown lesions, the matching predictions and the true lesion share of the leaf"""
+    rng = np.random.default_rng(seed)
+    width, height = side, side * 3 // 4
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = (110, 85, 60)
+    cv2.ellipse(image, (width // 2, height // 2), (int(width * 0.45), int(height * 0.2)), 8, 0, 360, (60, 140, 40), -1)
+    leaf = (image == (60, 140, 40)).all(axis=2)
+
+    lesions = np.zeros((height, width), np.uint8)
+    predictions = []
+    for _ in range(boxes):
+        # Lesions sit on the leaf, so draw them around random leaf pixels
+        ys, xs = np.nonzero(leaf)
+        pick = rng.integers(len(xs))
+        x, y = int(xs[pick]), int(ys[pick])
+        axes = (int(rng.integers(side // 60, side // 25)), int(rng.integers(side // 120, side // 60)))
+        cv2.ellipse(lesions, (x, y), axes, 8, 0, 360, 1, -1)
+        predictions.append({
+            "x": x, "y": y, "width": axes[0] * 2.6, "height": axes[1] * 2.6 + 6,
+            "confidence": 0.8, "class": "Brown Spot",
+        })
+    lesions = lesions.astype(bool) & leaf
+    image[lesions] = (140, 85, 35)
+
+    noise = rng.normal(0, 6, image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    return image, predictions, 100.0 * lesions.sum() / leaf.sum()
+
+
+def timed(fn, runs):
+    """Per-call milliseconds over runs calls, after a warm-up call"""
+    fn()
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return np.array(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the lesion severity stage")
+    parser.add_argument("--side", type=int, default=1024, help="longest side of the test image in px")
+    parser.add_argument("--boxes", type=int, default=5, help="predicted boxes on the leaf")
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--budget-ms", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    pixels, predictions, truth = synthetic_leaf(args.side, args.boxes, args.seed)
+    upload = encode(Image.fromarray(pixels), "JPEG", 85)
+
+    measured = lesion_severity(pixels, predictions)["percent"]
+    print(f"Image {pixels.shape[1]}x{pixels.shape[0]}, {args.boxes} boxes, single OpenCV thread")
+    print(f"Severity {measured:.2f}% (drawn lesions cover {truth:.2f}% of the leaf)")
+
+    over_budget = False
+    for name, fn in (
+        ("decoded pixels", lambda: lesion_severity(pixels, predictions)),
+        ("JPEG payload", lambda: upload_severity(upload, predictions)),
+    ):
+        times = timed(fn, args.runs)
+        p95 = np.percentile(times, 95)
+        over_budget |= p95 > args.budget_ms
+        print(f"{name:>15}: mean {times.mean():6.2f} ms  p50 {np.percentile(times, 50):6.2f} ms  "
+              f"p95 {p95:6.2f} ms  max {times.max():6.2f} ms  "
+              f"[{'over' if p95 > args.budget_ms else 'within'} {args.budget_ms:.0f} ms budget]")
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2217 @@
+# ========== IMPORTS ==========
+import base64
+import glob
+import hashlib
+import io
+import json
+import os
+import random
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import requests
+from collections import OrderedDict, deque
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from imaging import (
+    ARCHIVE_EXTENSIONS, ARCHIVE_FORMAT, ARCHIVE_TIERS, NMS_IOU, TILE_OVERLAP, TILE_SIZE, archive_extension,
+    archive_renditions, draw_predictions, hamming, healthy_confidence, match_thumbnails, nms, tile_boxes,
+    upload_severity
+)
+
+# Everything in this module lives for the whole server process. Streamlit
+# re-executes app.py on every rerun, but imported modules stay cached, so the
+# objects below are shared by all sessions.
+
+# ========== CONFIG ==========
+API_URL = os.environ.get("PALAY_API_URL", "https://serverless.roboflow.com")
+API_KEY = os.environ.get("PALAY_API_KEY", "KajReyLpzYwgJ8fJ8sVd")
+MODEL_ID = os.environ.get("PALAY_MODEL_ID", "palayprotector-project/1")
+DB_PATH = "users.db"
+
+# Which inference backend to use: "roboflow" (pooled HTTP), "sdk" (InferenceHTTPClient) or "local" (OpenCV DNN)
+BACKEND = os.environ.get("PALAY_BACKEND", "roboflow")
+LOCAL_MODEL_PATH = os.environ.get("PALAY_LOCAL_MODEL", "models/palayprotector.onnx")
+LOCAL_CLASSES_PATH = os.environ.get("PALAY_LOCAL_CLASSES", "models/palayprotector.names")
+LOCAL_INPUT_SIZE = int(os.environ.get("PALAY_LOCAL_INPUT_SIZE", "640"))
+LOCAL_CONFIDENCE = float(os.environ.get("PALAY_LOCAL_CONFIDENCE", "0.4"))
+LOCAL_NMS_IOU = float(os.environ.get("PALAY_LOCAL_NMS_IOU", "0.5"))
+
+POOL_SIZE = int(os.environ.get("PALAY_POOL_SIZE", "10"))
+REQUEST_TIMEOUT = float(os.environ.get("PALAY_REQUEST_TIMEOUT", "30"))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("PALAY_HEALTH_CHECK_INTERVAL", "60"))
+MAX_CONSECUTIVE_FAILURES = 3
+
+# Resilience around every inference call
+CALL_DEADLINE = float(os.environ.get("PALAY_CALL_DEADLINE", "20"))
+MAX_RETRIES = int(os.environ.get("PALAY_MAX_RETRIES", "2"))
+BACKOFF_BASE = float(os.environ.get("PALAY_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.environ.get("PALAY_BACKOFF_MAX", "4"))
+BREAKER_FAILURES = int(os.environ.get("PALAY_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.environ.get("PALAY_BREAKER_RESET", "30"))
+HEDGE_ENABLED = os.environ.get("PALAY_HEDGE", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("PALAY_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 500
+JPEG_QUALITY = 90
+TEMPFILE_MAX_AGE = 60 * 60
+
+CACHE_MEMORY_ITEMS = int(os.environ.get("PALAY_CACHE_MEMORY_ITEMS", "256"))
+CACHE_DISK_ITEMS = int(os.environ.get("PALAY_CACHE_DISK_ITEMS", "5000"))
+CACHE_TTL = float(os.environ.get("PALAY_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+DEDUP_WINDOW = float(os.environ.get("PALAY_DEDUP_WINDOW", str(10 * 60)))
+# Out of the 256 bits of a 16x16 dHash, so only a loose prefilter: hand-held re-shots land
+# anywhere from 20 to 140 bits apart, unrelated scans from about 115. Candidates are confirmed
+# on the registered thumbnails, the closest DEDUP_MAX_CANDIDATES of them at most.
+DEDUP_MAX_DISTANCE = int(os.environ.get("PALAY_DEDUP_MAX_DISTANCE", "96"))
+DEDUP_MAX_CANDIDATES = 3
+
+BATCH_WORKERS = int(os.environ.get("PALAY_BATCH_WORKERS", "4"))
+BATCH_ITEM_TIMEOUT = float(os.environ.get("PALAY_BATCH_ITEM_TIMEOUT", "45"))
+
+JOB_WORKERS = int(os.environ.get("PALAY_JOB_WORKERS", "4"))
+JOB_RETENTION = 24 * 60 * 60
+# Owner id stamped on job rows. Set it per server process (stable across restarts) so a
+# restarted process can fail the jobs its previous run left behind straight away.
+INSTANCE_ID = os.environ.get("PALAY_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Unfinished jobs older than this are dead whoever owned them; no scan takes nearly as long
+JOB_STALE_AFTER = 60 * 60
+# The detect page gives up on a job after every attempt could have hit its deadline, plus
+# slack for queueing behind other jobs, tiles and backoff
+JOB_POLL_TIMEOUT = CALL_DEADLINE * (MAX_RETRIES + 1) + 60
+
+# Post-processing defaults; admins override them from the Settings tab
+DEFAULT_POSTPROCESS = {
+    "min_confidence": 0.25,
+    "top_k": 10,
+    "class_thresholds": {},
+    "collapse_duplicates": False,
+}
+SETTINGS_TTL = 30
+
+# Shadow evaluation of a candidate model; model and sample rate are admin settings
+DEFAULT_SHADOW = {"model_id": "", "sample_rate": 0.0}
+SHADOW_WORKERS = 2
+SHADOW_MAX_PENDING = 20
+
+# Local healthy check that can answer "Healthy" without remote inference. It stays
+# off until an admin enables it, but audits are logged from the start so the
+# threshold can be calibrated first.
+DEFAULT_FAST_PATH = {"enabled": False, "threshold": 0.9, "audit_rate": 0.1}
+FAST_PATH_TARGET_AGREEMENT = 0.98
+FAST_PATH_MIN_SAMPLES = 30
+FAST_PATH_THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98]
+
+# Offline spool for scans that could not reach the inference endpoint
+SPOOL_DIR = os.environ.get("PALAY_SPOOL_DIR", "spool")
+SPOOL_POLL = float(os.environ.get("PALAY_SPOOL_POLL", "10"))
+SPOOL_BACKOFF_BASE = 15
+SPOOL_BACKOFF_MAX = 15 * 60
+SPOOL_MAX_ATTEMPTS = 50
+# A claimed item whose drainer has not finished within this long is assumed dead and retried
+SPOOL_LEASE = 10 * 60
+
+# Content-addressed archive of scanned images, garbage collected down to a size budget
+BLOB_DIR = os.environ.get("PALAY_BLOB_DIR", "blobs")
+BLOB_BUDGET_MB = float(os.environ.get("PALAY_BLOB_BUDGET_MB", "1024"))
+BLOB_GC_TARGET = 0.9
+ARCHIVE_WORKERS = 2
+
+
+# ========== IN-MEMORY ENCODING ==========
+def encode_image(image, quality=JPEG_QUALITY):
+    """Turn raw bytes, a PIL image, an RGB NumPy array or a file path into JPEG/PNG bytes"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if isinstance(image, str):
+        with open(image, "rb") as f:
+            return f.read()
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def sweep_leaked_tempfiles(max_age=TEMPFILE_MAX_AGE):
+    """Delete old tmp*.jpg files left behind by the former NamedTemporaryFile upload path"""
+    removed = 0
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), "tmp*.jpg")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # Another process may have removed it first
+            pass
+    return removed
+
+
+_sweeper_started = False
+_sweeper_lock = threading.Lock()
+
+
+def start_tempfile_sweeper():
+    """Run the tempfile sweep once per process in the background"""
+    global _sweeper_started
+    with _sweeper_lock:
+        if _sweeper_started:
+            return
+        _sweeper_started = True
+    threading.Thread(target=sweep_leaked_tempfiles, daemon=True).start()
+
+
+# ========== POOLED INFERENCE CLIENT ==========
+class PooledInferenceClient:
+    """Keep-alive HTTP client for the hosted inference API"""
+
+    def __init__(self, api_url=API_URL, api_key=API_KEY, pool_size=POOL_SIZE):
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.healthy = True
+        self.failures = 0
+        self.last_check = time.time()
+        self._lock = threading.Lock()
+        self.session = self._new_session()
+
+    def _new_session(self):
+        """Create a requests session that keeps up to pool_size connections open"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def reset(self):
+        """Drop every pooled connection and start a fresh session"""
+        with self._lock:
+            old_session = self.session
+            self.session = self._new_session()
+            self.failures = 0
+        old_session.close()
+
+    def _record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.healthy = True
+                return
+            self.failures += 1
+            recycle = self.failures >= MAX_CONSECUTIVE_FAILURES
+            if recycle:
+                self.healthy = False
+        if recycle:
+            # Stale keep-alive sockets are the usual cause of repeated connection errors
+            self.reset()
+
+    def infer(self, image, model_id=MODEL_ID):
+        """Run the hosted model on an in-memory image, same call shape as InferenceHTTPClient.infer"""
+        payload = base64.b64encode(encode_image(image)).decode("ascii")
+
+        try:
+            response = self.session.post(
+                f"{self.api_url}/{model_id}",
+                params={"api_key": self.api_key},
+                data=payload,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=REQUEST_TIMEOUT,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            self._record(False)
+            raise
+        self._record(True)
+        return response.json()
+
+    def health_check(self):
+        """Ping the API host and recycle the session if it cannot be reached"""
+        try:
+            response = self.session.get(self.api_url, timeout=5)
+            ok = response.status_code < 500
+        except requests.RequestException:
+            ok = False
+        with self._lock:
+            self.healthy = ok
+            self.last_check = time.time()
+        if not ok:
+            self.reset()
+        return ok
+
+    def maybe_health_check(self):
+        """Start a background health check when the last one is older than the interval"""
+        with self._lock:
+            if time.time() - self.last_check < HEALTH_CHECK_INTERVAL:
+                return
+            self.last_check = time.time()
+        threading.Thread(target=self.health_check, daemon=True).start()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_url=API_URL, api_key=API_KEY, pool_size=POOL_SIZE):
+    """Return the process-wide client for this endpoint, creating it on first use"""
+    key = (api_url, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = PooledInferenceClient(api_url, api_key, pool_size)
+            _clients[key] = client
+    client.maybe_health_check()
+    return client
+
+
+# ========== INFERENCE BACKENDS ==========
+class InferenceBackend:
+    """Something that turns an image into a Roboflow-style predictions dict
+
+    infer() returns {"image": {"width", "height"}, "predictions": [...]}
+    where every prediction has x, y, width, height (box centre and size in
+    pixels of the image it was given), confidence, class and class_id.
+    """
+
+    name = "base"
+    # False when the backend serves one fixed model whatever model_id says
+    selects_model = True
+
+    def infer(self, image, model_id=MODEL_ID):
+        raise NotImplementedError
+
+
+class RoboflowBackend(InferenceBackend):
+    """Hosted model through the shared keep-alive client"""
+
+    name = "roboflow"
+
+    def infer(self, image, model_id=MODEL_ID):
+        return get_client().infer(image, model_id=model_id)
+
+
+class SDKBackend(InferenceBackend):
+    """Hosted model through the inference_sdk InferenceHTTPClient"""
+
+    name = "sdk"
+
+    def __init__(self, api_url=API_URL, api_key=API_KEY):
+        from inference_sdk import InferenceHTTPClient
+        self.client = InferenceHTTPClient(api_url=api_url, api_key=api_key)
+
+    def infer(self, image, model_id=MODEL_ID):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = Image.open(io.BytesIO(image))
+        return self.client.infer(image, model_id=model_id)
+
+
+class LocalCVBackend(InferenceBackend):
+    """Exported YOLO ONNX model run on the CPU with OpenCV DNN"""
+
+    name = "local"
+    selects_model = False
+
+    def __init__(self, model_path=LOCAL_MODEL_PATH, classes_path=LOCAL_CLASSES_PATH,
+                 input_size=LOCAL_INPUT_SIZE, confidence=LOCAL_CONFIDENCE, nms_iou=LOCAL_NMS_IOU):
+        import cv2
+        self.cv2 = cv2
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        with open(classes_path) as f:
+            self.classes = [line.strip() for line in f if line.strip()]
+        self.input_size = input_size
+        self.confidence = confidence
+        self.nms_iou = nms_iou
+        # A cv2.dnn.Net must not run forward() from two threads at once
+        self._lock = threading.Lock()
+
+    def infer(self, image, model_id=MODEL_ID):
+        cv2 = self.cv2
+        data = encode_image(image)
+        bgr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        height, width = bgr.shape[:2]
+        blob = cv2.dnn.blobFromImage(bgr, 1 / 255.0, (self.input_size, self.input_size), swapRB=True, crop=False)
+        with self._lock:
+            self.net.setInput(blob)
+            output = self.net.forward()
+
+        rows = output[0]
+        num_classes = len(self.classes)
+        # YOLOv8 exports (4 + classes, boxes); YOLOv5 exports (boxes, 5 + classes) with objectness
+        if rows.shape[0] == 4 + num_classes:
+            rows = rows.T
+            boxes, scores = rows[:, :4], rows[:, 4:]
+        else:
+            boxes, scores = rows[:, :4], rows[:, 5:] * rows[:, 4:5]
+
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences >= self.confidence
+        boxes, class_ids, confidences = boxes[keep], class_ids[keep], confidences[keep]
+
+        scale = np.array([width, height, width, height], dtype=np.float32) / self.input_size
+        boxes = boxes * scale
+        corners = np.column_stack([boxes[:, 0] - boxes[:, 2] / 2, boxes[:, 1] - boxes[:, 3] / 2, boxes[:, 2], boxes[:, 3]])
+        indices = cv2.dnn.NMSBoxes(corners.tolist(), confidences.tolist(), self.confidence, self.nms_iou)
+
+        predictions = []
+        for i in np.array(indices).flatten():
+            predictions.append({
+                "x": float(boxes[i, 0]),
+                "y": float(boxes[i, 1]),
+                "width": float(boxes[i, 2]),
+                "height": float(boxes[i, 3]),
+                "confidence": float(confidences[i]),
+                "class": self.classes[class_ids[i]],
+                "class_id": int(class_ids[i]),
+            })
+        return {"image": {"width": width, "height": height}, "predictions": predictions}
+
+
+BACKENDS = {
+    "roboflow": RoboflowBackend,
+    "sdk": SDKBackend,
+    "local": LocalCVBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """Return the process-wide backend picked by PALAY_BACKEND (or by name), wrapped for resilience"""
+    name = name or BACKEND
+    with _backends_lock:
+        backend = _backends.get(name)
+        if backend is None:
+            if name not in BACKENDS:
+                raise ValueError(f"Unknown inference backend: {name}")
+            backend = ResilientBackend(BACKENDS[name]())
+            _backends[name] = backend
+    return backend
+
+
+# ========== RESILIENCE ==========
+class CircuitOpenError(Exception):
+    """Raised without calling the backend while the circuit breaker is open"""
+
+
+class InferenceMetrics:
+    """Thread-safe counters and a rolling latency window for inference calls"""
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self._lock = threading.Lock()
+        self.latencies = deque(maxlen=samples)
+        self.counters = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "breaker_rejections": 0,
+            "breaker_trips": 0,
+            "hedges_sent": 0,
+            "hedges_won": 0,
+        }
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, pct):
+        """Latency percentile over the rolling window, or None with too few samples"""
+        with self._lock:
+            values = sorted(self.latencies)
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        index = min(int(len(values) * pct / 100), len(values) - 1)
+        return values[index]
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counters)
+            values = sorted(self.latencies)
+        for pct in (50, 95, 99):
+            stats[f"p{pct}"] = values[min(int(len(values) * pct / 100), len(values) - 1)] if values else None
+        return stats
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures, half-open after a cool-down, closed on success"""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET, metrics=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go through right now"""
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                # Let exactly one trial call through
+                self.state = "half_open"
+                return True
+            if self.state == "half_open":
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.metrics is not None and self.state != "open":
+                    self.metrics.count("breaker_trips")
+                self.state = "open"
+                self.opened_at = time.time()
+
+
+def is_transient_failure(error):
+    """Whether a failed inference is worth keeping for later: retryable errors and an open circuit"""
+    return _is_retryable(error) or isinstance(error, CircuitOpenError)
+
+
+def _is_retryable(error):
+    """Network trouble, timeouts and 429/5xx answers are worth another try"""
+    if isinstance(error, (TimeoutError, requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+_call_pool = None
+_call_pool_lock = threading.Lock()
+
+
+def _get_call_pool():
+    global _call_pool
+    with _call_pool_lock:
+        if _call_pool is None:
+            # Room for a primary and a hedge per pooled connection
+            _call_pool = ThreadPoolExecutor(max_workers=POOL_SIZE * 2, thread_name_prefix="palay-call")
+    return _call_pool
+
+
+class ResilientBackend(InferenceBackend):
+    """Wraps a backend with a deadline, jittered retries, a circuit breaker and hedging"""
+
+    def __init__(self, backend, deadline=CALL_DEADLINE, max_retries=MAX_RETRIES, hedge=HEDGE_ENABLED):
+        self.backend = backend
+        self.name = backend.name
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.metrics = InferenceMetrics()
+        self.breaker = CircuitBreaker(metrics=self.metrics)
+
+    def _attempt(self, image, model_id, timeout):
+        """One logical attempt, possibly raced against a hedged duplicate"""
+        pool = _get_call_pool()
+        started = time.time()
+        primary = pool.submit(self.backend.infer, image, model_id)
+        pending = {primary}
+
+        hedge_after = self.metrics.percentile(HEDGE_PERCENTILE) if self.hedge else None
+        if hedge_after is not None and hedge_after < timeout:
+            done, _ = wait(pending, timeout=hedge_after)
+            if not done:
+                pending.add(pool.submit(self.backend.infer, image, model_id))
+                self.metrics.count("hedges_sent")
+
+        error = None
+        while pending:
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is not primary:
+                    self.metrics.count("hedges_won")
+                self.metrics.observe(time.time() - started)
+                return result
+        if pending or error is None:
+            self.metrics.count("timeouts")
+            raise TimeoutError(f"Inference took longer than {timeout:.1f}s")
+        raise error
+
+    def infer(self, image, model_id=MODEL_ID):
+        self.metrics.count("calls")
+        started = time.time()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.metrics.count("breaker_rejections")
+                raise CircuitOpenError("Detection service is temporarily unavailable, please try again shortly.")
+            remaining = self.deadline - (time.time() - started)
+            try:
+                result = self._attempt(image, model_id, remaining)
+            except Exception as e:
+                retryable = _is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    # The endpoint answered; the request itself was bad
+                    self.breaker.record_success()
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                out_of_time = time.time() - started + delay >= self.deadline
+                if attempt >= self.max_retries or out_of_time or not retryable:
+                    self.metrics.count("failures")
+                    raise
+                attempt += 1
+                self.metrics.count("retries")
+                # Full jitter keeps retries from many sessions from arriving in lockstep
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self.metrics.count("successes")
+            return result
+
+    def snapshot(self):
+        """Metrics plus the breaker state, for the admin dashboard"""
+        stats = self.metrics.snapshot()
+        stats["breaker_state"] = self.breaker.state
+        return stats
+
+
+# ========== INFERENCE RESULT CACHE ==========
+def content_hash(data):
+    """SHA-256 hex digest of the encoded image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(data, model_id, params=None):
+    """Key a result by image content, model and the inference parameters used"""
+    params_json = json.dumps(params or {}, sort_keys=True)
+    raw = f"{content_hash(data)}|{model_id}|{params_json}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class InferenceCache:
+    """Two-tier result cache: in-memory LRU in front of a SQLite table
+
+    The SQLite tier is best-effort: when users.db is busy a lookup falls
+    through to a miss and a store keeps only the in-memory copy, so a
+    paid inference is never lost to a locked database.
+    """
+
+    def __init__(self, db_path=DB_PATH, memory_items=CACHE_MEMORY_ITEMS,
+                 disk_items=CACHE_DISK_ITEMS, ttl=CACHE_TTL):
+        self.db_path = db_path
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "errors": 0}
+        self._init_table()
+
+    def _init_table(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        # Jobs, archiving, the spool and this cache all write to users.db; in WAL mode readers
+        # never block on them and writers only wait for each other. The setting sticks to the file.
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            # Busy right now; the next process start switches it
+            pass
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS inference_cache (
+                key TEXT PRIMARY KEY,
+                model_id TEXT,
+                result TEXT,
+                created_at REAL,
+                last_access REAL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_inference_cache_access ON inference_cache (last_access)")
+        conn.commit()
+        conn.close()
+
+    def _remember(self, key, created_at, result):
+        """Put an entry at the front of the LRU, evicting the oldest if full"""
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, key, count=True):
+        """Return a cached result or None
+
+        count=False peeks without touching the hit/miss counters, for a
+        second look at a key whose miss was already counted.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    if count:
+                        self.stats["memory_hits"] += 1
+                    return result
+                del self._memory[key]
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT result, created_at FROM inference_cache WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                cursor.execute("DELETE FROM inference_cache WHERE key = ?", (key,))
+                row = None
+            elif row is not None:
+                cursor.execute("UPDATE inference_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Inference cache lookup failed:", e)
+            self._count("errors")
+            row = None
+        finally:
+            conn.close()
+        if row is None:
+            if count:
+                self._count("misses")
+            return None
+
+        result = json.loads(row[0])
+        with self._lock:
+            self._remember(key, row[1], result)
+            if count:
+                self.stats["disk_hits"] += 1
+        return result
+
+    def put(self, key, model_id, result):
+        """Store a result in both tiers and trim the SQLite tier to its size cap"""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, result)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO inference_cache (key, model_id, result, created_at, last_access)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, model_id, json.dumps(result), now, now))
+            cursor.execute("DELETE FROM inference_cache WHERE created_at < ?", (now - self.ttl,))
+            cursor.execute("""
+                DELETE FROM inference_cache WHERE key IN (
+                    SELECT key FROM inference_cache
+                    ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (self.disk_items,))
+            conn.commit()
+        except sqlite3.Error as e:
+            print("Inference cache store failed:", e)
+            self._count("errors")
+        finally:
+            conn.close()
+
+    def snapshot(self):
+        """Copy of the hit/miss counters plus the current hit rate"""
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide inference cache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = InferenceCache()
+    return _cache
+
+
+# ========== SINGLEFLIGHT ==========
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one; every caller gets its result
+
+    stats["leaders"] counts flights that really went upstream; the
+    flight's fn reports that through count_leader().
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            # The leader's own deadline bounds how long this can take
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"]
+
+    def count_leader(self):
+        with self._lock:
+            self.stats["leaders"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+
+_inflight = SingleFlight()
+
+
+def cached_infer(image, model_id=MODEL_ID, params=None):
+    """Run inference through the result cache so repeated images skip the remote call
+
+    Identical requests already in flight from other sessions wait for
+    that call instead of starting their own.
+    """
+    data = encode_image(image)
+    backend = get_backend()
+    key = cache_key(data, model_id, {**(params or {}), "backend": backend.name})
+    cache = get_cache()
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    def fetch():
+        # A flight that finished between the cache check and joining _inflight has already stored it
+        result = cache.get(key, count=False)
+        if result is not None:
+            return result
+        _inflight.count_leader()
+        started = time.time()
+        result = backend.infer(data, model_id=model_id)
+        latency = time.time() - started
+        cache.put(key, model_id, result)
+        maybe_shadow(data, model_id, result, latency)
+        return result
+
+    return _inflight.do(key, fetch)
+
+
+# ========== NEAR-DUPLICATE INDEX ==========
+class BKTree:
+    """Burkhard-Keller tree over integer hashes using Hamming distance"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        node = [value, item, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, max_distance):
+        """Return (distance, item) pairs within max_distance, closest first"""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, item, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.append((distance, item))
+            # Triangle inequality: only subtrees in this band can hold matches
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class NearDuplicateIndex:
+    """Per-user BK-trees over the perceptual hashes of recent scans"""
+
+    def __init__(self, db_path=DB_PATH, window=DEDUP_WINDOW, max_distance=DEDUP_MAX_DISTANCE):
+        self.db_path = db_path
+        self.window = window
+        self.max_distance = max_distance
+        self._trees = {}
+        self._lock = threading.Lock()
+
+    def _load(self, user_id):
+        """Build a tree from the user's scans inside the window, healthy ones included"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.id, s.phash, strftime('%s', s.created_at), s.thumbnail, s.payload, h.result, h.confidence
+            FROM scans s
+            LEFT JOIN history h ON h.scan_id = s.id
+            WHERE s.user_id = ? AND s.thumbnail IS NOT NULL
+              AND length(s.phash) = 64
+              AND s.created_at >= datetime('now', ?)
+        """, (user_id, f"-{int(self.window)} seconds"))
+        rows = cursor.fetchall()
+        conn.close()
+
+        scans = {}
+        for scan_id, phash, created_at, thumbnail, payload, disease, confidence in rows:
+            if scan_id in scans:
+                scan = scans[scan_id]
+            elif payload is not None:
+                # The packed payload keeps the boxes, not just class and confidence
+                unpacked = unpack_predictions(payload)
+                scan = {"phash": phash, "created_at": float(created_at), "thumbnail": thumbnail, "packed": True,
+                        "image": unpacked["image"], "predictions": unpacked["predictions"]}
+                scans[scan_id] = scan
+            else:
+                scan = {"phash": phash, "created_at": float(created_at), "thumbnail": thumbnail, "packed": False,
+                        "predictions": []}
+                scans[scan_id] = scan
+            if disease is not None and not scan["packed"]:
+                scan["predictions"].append({"class": disease, "confidence": confidence / 100})
+
+        tree = BKTree()
+        for scan in scans.values():
+            tree.add(int(scan["phash"], 16), scan)
+        return {"tree": tree, "loaded_at": time.time()}
+
+    def _tree(self, user_id):
+        entry = self._trees.get(user_id)
+        # Rebuild once per window so expired scans drop out of the tree
+        if entry is None or time.time() - entry["loaded_at"] > self.window:
+            entry = self._load(user_id)
+            self._trees[user_id] = entry
+        return entry["tree"]
+
+    def lookup(self, user_id, phash, thumbnail):
+        """Return the stored result of a near-identical scan inside the window, or None
+
+        Hash matches are confirmed against the stored thumbnail, since a
+        leaf that has developed a few lesions hashes almost the same. The
+        stored boxes are moved along with the picture between the shots.
+        """
+        if user_id is None:
+            return None
+        cutoff = time.time() - self.window
+        with self._lock:
+            matches = self._tree(user_id).search(phash, self.max_distance)
+        candidates = [scan for _, scan in matches if scan["created_at"] >= cutoff][:DEDUP_MAX_CANDIDATES]
+        for scan in candidates:
+            motion = match_thumbnails(scan["thumbnail"], thumbnail)
+            if motion is not None:
+                result = {"image": scan.get("image"), "predictions": scan["predictions"], "near_duplicate": True}
+                return move_predictions(result, motion)
+        return None
+
+    def add(self, user_id, phash, result, thumbnail):
+        """Index a fresh scan so later re-shots can reuse it"""
+        if user_id is None or thumbnail is None:
+            return
+        scan = {"created_at": time.time(), "thumbnail": thumbnail, "image": result.get("image"),
+                "predictions": result.get("predictions", [])}
+        with self._lock:
+            self._tree(user_id).add(phash, scan)
+
+
+_near_duplicates = None
+_near_duplicates_lock = threading.Lock()
+
+
+def get_near_duplicate_index():
+    """Return the process-wide near-duplicate index"""
+    global _near_duplicates
+    with _near_duplicates_lock:
+        if _near_duplicates is None:
+            _near_duplicates = NearDuplicateIndex()
+    return _near_duplicates
+
+
+# ========== BATCH DETECTION ==========
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+
+def get_batch_pool():
+    """Return the process-wide worker pool that bounds concurrent batch inference"""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="palay-batch")
+    return _batch_pool
+
+
+def run_batch(fn, items, timeout=BATCH_ITEM_TIMEOUT):
+    """Run fn over items on the shared pool, yielding (index, result, error) as each finishes
+
+    The timeout counts from when a worker picks the item up, so queueing
+    behind other sessions does not eat into it. A timed-out item is
+    reported with a TimeoutError and its thread is left to finish alone.
+    """
+    started = {}
+
+    def timed(index, item):
+        started[index] = time.time()
+        return fn(item)
+
+    pool = get_batch_pool()
+    futures = {pool.submit(timed, index, item): index for index, item in enumerate(items)}
+    pending = set(futures)
+    while pending:
+        now = time.time()
+        for future in [f for f in pending if futures[f] in started and now - started[futures[f]] > timeout]:
+            pending.discard(future)
+            yield futures[future], None, TimeoutError(f"No result after {timeout:.0f}s")
+
+        deadlines = [started[futures[f]] + timeout - now for f in pending if futures[f] in started]
+        wait_for = max(min(deadlines), 0.05) if deadlines else 0.5
+        done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+# ========== TILED INFERENCE ==========
+def tiled_infer(image, model_id=MODEL_ID, tile=TILE_SIZE, overlap=TILE_OVERLAP, iou=NMS_IOU):
+    """Run inference on overlapping tiles of a large image and merge the boxes
+
+    Tiles go through the batch pool concurrently. Each box is shifted
+    from tile to image coordinates, then duplicates from overlapping
+    tiles are merged with class-aware NMS.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image)).convert("RGB")
+    pixels = np.asarray(image)
+    height, width = pixels.shape[:2]
+    tiles = tile_boxes(width, height, tile, overlap)
+
+    def infer_tile(box):
+        left, top, right, bottom = box
+        return cached_infer(np.ascontiguousarray(pixels[top:bottom, left:right]), model_id=model_id)
+
+    predictions = []
+    for index, result, error in run_batch(infer_tile, tiles):
+        if error is not None:
+            raise error
+        left, top = tiles[index][:2]
+        for pred in result.get("predictions", []):
+            predictions.append({**pred, "x": pred["x"] + left, "y": pred["y"] + top})
+
+    if predictions:
+        boxes = np.array([
+            [p["x"] - p["width"] / 2, p["y"] - p["height"] / 2, p["x"] + p["width"] / 2, p["y"] + p["height"] / 2]
+            for p in predictions
+        ])
+        scores = np.array([p["confidence"] for p in predictions])
+        labels = np.array([p["class"] for p in predictions])
+        predictions = [predictions[i] for i in nms(boxes, scores, labels, iou)]
+
+    return {"image": {"width": width, "height": height}, "predictions": predictions, "tiles": len(tiles)}
+
+
+# ========== SUMMARIES ==========
+def summarize_predictions(results):
+    """Per-disease totals over many scans, e.g. the frames of a field walk video
+
+    Each disease counts at most once per scan, using its best confidence there.
+    """
+    summary = {}
+    for result in results:
+        best = {}
+        for pred in result.get("predictions", []):
+            best[pred["class"]] = max(best.get(pred["class"], 0.0), pred["confidence"])
+        for disease, confidence in best.items():
+            entry = summary.setdefault(disease, {"scans": 0, "max_confidence": 0.0, "total_confidence": 0.0})
+            entry["scans"] += 1
+            entry["max_confidence"] = max(entry["max_confidence"], confidence)
+            entry["total_confidence"] += confidence
+    for entry in summary.values():
+        entry["mean_confidence"] = entry.pop("total_confidence") / entry["scans"]
+    return summary
+
+
+# ========== POST-PROCESSING ==========
+def init_settings_table(db_path=DB_PATH):
+    """Key/value table for settings admins change at runtime"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS app_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+
+def get_setting(key, default, db_path=DB_PATH):
+    """Read a JSON setting, cached for SETTINGS_TTL seconds so other server processes pick changes up"""
+    with _settings_lock:
+        cached = _settings_cache.get(key)
+        if cached is not None and time.time() - cached[0] < SETTINGS_TTL:
+            return cached[1]
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT value FROM app_settings WHERE key = ?", (key,))
+        row = cursor.fetchone()
+    except sqlite3.OperationalError:
+        # Table not created yet
+        row = None
+    conn.close()
+    value = json.loads(row[0]) if row else default
+    with _settings_lock:
+        _settings_cache[key] = (time.time(), value)
+    return value
+
+
+def set_setting(key, value, db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT OR REPLACE INTO app_settings (key, value, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+    """, (key, json.dumps(value)))
+    conn.commit()
+    conn.close()
+    with _settings_lock:
+        _settings_cache[key] = (time.time(), value)
+
+
+def get_postprocess_settings():
+    """Current post-processing settings, falling back to the defaults for missing keys"""
+    return {**DEFAULT_POSTPROCESS, **get_setting("postprocess", {})}
+
+
+def postprocess(result, settings=None):
+    """Filter a raw inference result by confidence, per-class thresholds, duplicates and top-k
+
+    Raw results are what gets cached, so changing these settings takes
+    effect immediately without re-running inference.
+    """
+    settings = settings or get_postprocess_settings()
+    class_thresholds = settings["class_thresholds"]
+    kept = [
+        pred for pred in result.get("predictions", [])
+        if pred["confidence"] >= class_thresholds.get(pred["class"], settings["min_confidence"])
+    ]
+    kept.sort(key=lambda pred: pred["confidence"], reverse=True)
+    if settings["collapse_duplicates"]:
+        seen = set()
+        kept = [pred for pred in kept if not (pred["class"] in seen or seen.add(pred["class"]))]
+    if settings["top_k"]:
+        kept = kept[:settings["top_k"]]
+    return {**result, "predictions": kept}
+
+
+# ========== PREDICTION PAYLOADS ==========
+def to_frame_coordinates(result, offset=(0, 0), size=None):
+    """Shift boxes from the uploaded crop back into the coordinates of the decoded frame"""
+    left, top = offset
+    predictions = [
+        {**pred, "x": pred["x"] + left, "y": pred["y"] + top} if "x" in pred else pred
+        for pred in result.get("predictions", [])
+    ]
+    image = {"width": size[0], "height": size[1]} if size else result.get("image")
+    return {**result, "image": image, "predictions": predictions}
+
+
+def rescale_to_frame(result, size):
+    """Scale boxes from the frame in result["image"] to a frame of the given (width, height)"""
+    image = result.get("image") or {}
+    scale_x = size[0] / (image.get("width") or size[0])
+    scale_y = size[1] / (image.get("height") or size[1])
+    predictions = [
+        {**pred, "x": pred["x"] * scale_x, "y": pred["y"] * scale_y,
+         "width": pred["width"] * scale_x, "height": pred["height"] * scale_y} if "x" in pred else pred
+        for pred in result.get("predictions", [])
+    ]
+    return {**result, "image": {"width": size[0], "height": size[1]}, "predictions": predictions}
+
+
+def move_predictions(result, motion):
+    """Carry boxes through a 2x3 affine map given in fractions of the frame, e.g. from a re-shot
+
+    Boxes whose centre leaves the frame are dropped.
+    """
+    image = result.get("image") or {}
+    width, height = image.get("width"), image.get("height")
+    if not width or not height:
+        return result
+    # How much the map stretches each axis, in pixels
+    scale_x = float(np.hypot(motion[0, 0], motion[1, 0] * height / width))
+    scale_y = float(np.hypot(motion[0, 1] * width / height, motion[1, 1]))
+    predictions = []
+    for pred in result.get("predictions", []):
+        if "x" not in pred:
+            predictions.append(pred)
+            continue
+        x, y = motion @ (pred["x"] / width, pred["y"] / height, 1.0)
+        if 0 <= x <= 1 and 0 <= y <= 1:
+            predictions.append({**pred, "x": float(x * width), "y": float(y * height),
+                                "width": pred["width"] * scale_x, "height": pred["height"] * scale_y})
+    return {**result, "predictions": predictions}
+
+
+def pack_predictions(result):
+    """Compact binary form of a result: small JSON header, float32 boxes, uint16 class indices"""
+    predictions = result.get("predictions", [])
+    classes = sorted({pred["class"] for pred in predictions})
+    lookup = {name: index for index, name in enumerate(classes)}
+    boxes = np.array([
+        [pred.get("x", 0), pred.get("y", 0), pred.get("width", 0), pred.get("height", 0), pred["confidence"]]
+        for pred in predictions
+    ], dtype="<f4").reshape(-1, 5)
+    labels = np.array([lookup[pred["class"]] for pred in predictions], dtype="<u2")
+    image = result.get("image") or {}
+    header = {"v": 1, "classes": classes, "width": image.get("width"), "height": image.get("height")}
+    if result.get("severity"):
+        header["severity"] = result["severity"]
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return struct.pack("<HH", len(header), len(predictions)) + header + boxes.tobytes() + labels.tobytes()
+
+
+def unpack_predictions(blob):
+    """Inverse of pack_predictions"""
+    header_length, count = struct.unpack_from("<HH", blob)
+    header = json.loads(blob[4:4 + header_length])
+    offset = 4 + header_length
+    boxes = np.frombuffer(blob, dtype="<f4", count=count * 5, offset=offset).reshape(count, 5)
+    labels = np.frombuffer(blob, dtype="<u2", count=count, offset=offset + count * 20)
+    unpacked = {
+        "image": {"width": header["width"], "height": header["height"]},
+        "predictions": [
+            {
+                "x": float(box[0]),
+                "y": float(box[1]),
+                "width": float(box[2]),
+                "height": float(box[3]),
+                "confidence": float(box[4]),
+                "class": header["classes"][label],
+            }
+            for box, label in zip(boxes, labels)
+        ],
+    }
+    if "severity" in header:
+        unpacked["severity"] = header["severity"]
+    return unpacked
+
+
+# ========== IMAGE BLOB STORE ==========
+class BlobStore:
+    """Scanned images on disk, addressed by the sha256 of the uploaded bytes
+
+    Each image is stored once, however often it is uploaded, as a
+    "full" rendition plus the smaller ARCHIVE_TIERS in ARCHIVE_FORMAT,
+    under root/ab/cd/<hash>.<tier>.<ext>. The blobs table tracks sizes and last
+    use; when the total passes the budget, collect() deletes images no
+    scan refers to first, then the least recently used ones.
+    """
+
+    def __init__(self, root=BLOB_DIR, budget_mb=BLOB_BUDGET_MB, db_path=DB_PATH):
+        self.root = root
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.stats = {"stored": 0, "deduplicated": 0, "collected": 0}
+        self._init_table()
+
+    def _init_table(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                bytes INTEGER,
+                width INTEGER,
+                height INTEGER,
+                created_at REAL,
+                last_used_at REAL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_blobs_last_used ON blobs (last_used_at)")
+        cursor.execute("SELECT COALESCE(SUM(bytes), 0) FROM blobs")
+        self._total = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+
+    def path(self, digest, tier="full", fmt=ARCHIVE_FORMAT):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{tier}.{archive_extension(fmt)}")
+
+    def put(self, data):
+        """Archive an upload and return its hash; a repeat upload only refreshes last use"""
+        digest = content_hash(data)
+        now = time.time()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE blobs SET last_used_at = ? WHERE hash = ?", (now, digest))
+        conn.commit()
+        conn.close()
+        if cursor.rowcount:
+            with self._lock:
+                self.stats["deduplicated"] += 1
+            return digest
+
+        renditions, width, height = archive_renditions(data)
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        for tier, blob in renditions.items():
+            # Write-then-rename, so readers never see a half-written file
+            tmp_path = f"{self.path(digest, tier)}.{uuid.uuid4().hex}.part"
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, self.path(digest, tier))
+        size = sum(len(blob) for blob in renditions.values())
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO blobs (hash, bytes, width, height, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (digest, size, width, height, now, now))
+        inserted = cursor.rowcount
+        conn.commit()
+        conn.close()
+
+        with self._lock:
+            # Another thread may have archived the same image at the same moment
+            if inserted:
+                self._total += size
+                self.stats["stored"] += 1
+            else:
+                self.stats["deduplicated"] += 1
+            over_budget = self._total > self.budget
+        if over_budget:
+            self.collect()
+        return digest
+
+    def find(self, digest, tier="full"):
+        """(bytes, format) of one rendition, or (None, None) if it was never stored or has been collected
+
+        Images archived before ARCHIVE_FORMAT was changed keep their old
+        format, so the other formats are tried too.
+        """
+        if not digest:
+            return None, None
+        for fmt in [ARCHIVE_FORMAT, *(other for other in ARCHIVE_EXTENSIONS if other != ARCHIVE_FORMAT)]:
+            try:
+                with open(self.path(digest, tier, fmt), "rb") as f:
+                    return f.read(), fmt
+            except OSError:
+                continue
+        return None, None
+
+    def get(self, digest, tier="full"):
+        """Bytes of one rendition, or None if it was never stored or has been collected"""
+        return self.find(digest, tier)[0]
+
+    def _delete(self, cursor, digest):
+        for name in ["full", *ARCHIVE_TIERS]:
+            for fmt in ARCHIVE_EXTENSIONS:
+                try:
+                    os.remove(self.path(digest, name, fmt))
+                except OSError:
+                    pass
+        cursor.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+
+    def collect(self, budget=None):
+        """Delete images until the store is under BLOB_GC_TARGET of its budget
+
+        Images that no scan or spooled scan refers to go first, oldest
+        first; after that the least recently used are evicted even if
+        referenced, so storage never outgrows the budget. Their scans
+        keep the hash, and get() simply returns None for them.
+        """
+        budget = self.budget if budget is None else budget
+        target = budget * BLOB_GC_TARGET
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT b.hash, b.bytes
+            FROM blobs b
+            ORDER BY
+                EXISTS (SELECT 1 FROM scans s WHERE s.image_hash = b.hash)
+                OR EXISTS (SELECT 1 FROM spool_queue q WHERE q.image_hash = b.hash),
+                b.last_used_at
+        """)
+        candidates = cursor.fetchall()
+        cursor.execute("SELECT COALESCE(SUM(bytes), 0) FROM blobs")
+        total = cursor.fetchone()[0]
+
+        collected = 0
+        for digest, size in candidates:
+            if total <= target:
+                break
+            self._delete(cursor, digest)
+            total -= size
+            collected += 1
+        conn.commit()
+        conn.close()
+
+        with self._lock:
+            self._total = total
+            self.stats["collected"] += collected
+        return collected
+
+    def snapshot(self):
+        """Counters plus stored image count and bytes against the budget"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM blobs")
+        images, total = cursor.fetchone()
+        conn.close()
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(images=images, bytes=total, budget=self.budget)
+        return stats
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """Return the process-wide image blob store"""
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore()
+    return _blob_store
+
+
+_archive_pool = None
+_archive_pool_lock = threading.Lock()
+
+# How each table that can wait on an archived original is pointed at it
+_ARCHIVE_UPDATES = {
+    # An overlay drawn before the archive existed used the thumbnail, so let it redraw on the preview
+    "scans": "UPDATE scans SET image_hash = ?, overlay = NULL WHERE id = ?",
+    "spool_queue": "UPDATE spool_queue SET image_hash = ? WHERE id = ?",
+}
+
+
+def _archive_images(pending, db_path, table):
+    for row_id, image in pending:
+        try:
+            image_hash = get_blob_store().put(image)
+        except Exception as e:
+            print("Archiving", table, row_id, "failed:", e)
+            continue
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute(_ARCHIVE_UPDATES[table], (image_hash, row_id))
+        conn.commit()
+        conn.close()
+
+
+def archive_scan_images(pending, db_path=DB_PATH, table="scans"):
+    """Archive (row id, image bytes) pairs in the background and point each row at its blob
+
+    Decoding and encoding the WebP tiers takes most of a second for a
+    large photo, far too long for the page or the batch loop to wait on.
+    table is "scans", or "spool_queue" for scans still in the spool.
+    """
+    global _archive_pool
+    with _archive_pool_lock:
+        if _archive_pool is None:
+            _archive_pool = ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS, thread_name_prefix="palay-archive")
+    _archive_pool.submit(_archive_images, pending, db_path, table)
+
+
+# ========== DETECTION HISTORY ==========
+def save_scans(user_id, scans, db_path=DB_PATH):
+    """Persist scans and their predictions in a single transaction
+
+    scans is a list of dicts with phash, result and source, plus an
+    optional thumbnail, deferred flag and the uploaded image (or the
+    image_hash it was already archived under). Images are archived in
+    the background and scans.image_hash is set once that finishes.
+    result may carry the lesion_severity of the scan, whose percent is
+    kept in scans.severity. Boxes in result must already be in frame
+    coordinates (see to_frame_coordinates). Each scan gets a parent row
+    in scans holding the packed payload, and its predictions go to
+    history in one executemany. Returns the new scan ids in order.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    scan_ids = []
+    to_archive = []
+    try:
+        for scan in scans:
+            phash = scan["phash"]
+            phash_hex = f"{phash:064x}" if phash is not None else None
+            predictions = scan["result"].get("predictions", [])
+            severity = (scan["result"].get("severity") or {}).get("percent")
+            cursor.execute("""
+                INSERT INTO scans (user_id, source, phash, prediction_count, payload, thumbnail, deferred,
+                                   image_hash, severity)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                user_id, scan["source"], phash_hex, len(predictions), pack_predictions(scan["result"]),
+                scan.get("thumbnail"), int(scan.get("deferred", False)), scan.get("image_hash"), severity,
+            ))
+            scan_id = cursor.lastrowid
+            if scan.get("image"):
+                to_archive.append((scan_id, scan["image"]))
+            cursor.executemany("""
+                INSERT INTO history (user_id, scan_id, result, confidence, phash)
+                VALUES (?, ?, ?, ?, ?)
+            """, [
+                (user_id, scan_id, pred["class"], pred["confidence"] * 100, phash_hex)
+                for pred in predictions
+            ])
+            scan_ids.append(scan_id)
+        conn.commit()
+    finally:
+        conn.close()
+    if to_archive:
+        archive_scan_images(to_archive, db_path)
+    return scan_ids
+
+
+def save_detection(user_id, phash, result, source="single", thumbnail=None, deferred=False,
+                   image=None, image_hash=None, db_path=DB_PATH):
+    """Persist one scan and return its id"""
+    scan = {
+        "phash": phash, "result": result, "source": source, "thumbnail": thumbnail,
+        "deferred": deferred, "image": image, "image_hash": image_hash,
+    }
+    return save_scans(user_id, [scan], db_path)[0]
+
+
+def get_scan_result(scan_id, db_path=DB_PATH):
+    """Stored predictions of a scan, with boxes, or None"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT payload FROM scans WHERE id = ?", (scan_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None or row[0] is None:
+        return None
+    return unpack_predictions(row[0])
+
+
+def get_scan_image(scan_id, tier="full", db_path=DB_PATH):
+    """(bytes, format) of a scan's archived image in the given tier, or (None, None) if none was kept"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT image_hash FROM scans WHERE id = ?", (scan_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        return None, None
+    return get_blob_store().find(row[0], tier)
+
+
+def get_scan_overlay(scan_id, db_path=DB_PATH):
+    """JPEG of the scan with its detections drawn on, rendered once and cached
+
+    Drawn on the archived preview tier when the image is still in the
+    blob store, otherwise on the inline thumbnail. A thumbnail rendering
+    is not cached while the scan is still waiting to be archived.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT overlay, thumbnail, payload, image_hash FROM scans WHERE id = ?", (scan_id,))
+    row = cursor.fetchone()
+    if row is None or row[2] is None:
+        conn.close()
+        return None
+    overlay, thumbnail, payload, image_hash = row
+    if overlay is None:
+        canvas = get_blob_store().get(image_hash, "preview") or thumbnail
+        if canvas is None:
+            conn.close()
+            return None
+        overlay = draw_predictions(canvas, unpack_predictions(payload))
+        if image_hash is not None:
+            cursor.execute("UPDATE scans SET overlay = ? WHERE id = ?", (overlay, scan_id))
+            conn.commit()
+    conn.close()
+    return overlay
+
+
+# ========== BACKGROUND DETECTION JOBS ==========
+_process_started = time.time()
+_job_pool = None
+_job_pool_lock = threading.Lock()
+_job_table_ready = False
+
+
+def init_job_table(db_path=DB_PATH):
+    """Create the job table and fail jobs that a previous run never finished, once per process
+
+    Other server processes may share the database, so only this
+    instance's own jobs from before it started are failed, plus jobs so
+    old that no live worker can still be on them.
+    """
+    global _job_table_ready
+    with _job_pool_lock:
+        if _job_table_ready:
+            return
+        _job_table_ready = True
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_jobs (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            status TEXT,
+            result TEXT,
+            error TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL,
+            owner TEXT
+        )
+    """)
+    try:
+        cursor.execute("ALTER TABLE detection_jobs ADD COLUMN owner TEXT")
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+    # Queued work only lives in its owner's pool, so it cannot survive a restart
+    cursor.execute("""
+        UPDATE detection_jobs SET status = 'failed', error = 'Interrupted by a server restart', finished_at = ?
+        WHERE status IN ('queued', 'running')
+          AND ((owner = ? AND created_at < ?) OR created_at < ?)
+    """, (time.time(), INSTANCE_ID, _process_started, time.time() - JOB_STALE_AFTER))
+    cursor.execute("DELETE FROM detection_jobs WHERE finished_at < ?", (time.time() - JOB_RETENTION,))
+    conn.commit()
+    conn.close()
+
+
+def _update_job(job_id, db_path=DB_PATH, **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE detection_jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    conn.commit()
+    conn.close()
+
+
+def _process_scan(user_id, upload, phash, model_id, tiled, frame, deferred=False):
+    """Infer, filter and save one scan; shared by the job pool and the spool drainer"""
+    if tiled:
+        result = tiled_infer(upload, model_id=model_id)
+    else:
+        result = cached_infer(upload, model_id=model_id)
+    result = postprocess(to_frame_coordinates(result, frame.get("offset", (0, 0)), frame.get("size")))
+    if result["predictions"]:
+        result["severity"] = upload_severity(upload, result["predictions"], frame.get("offset", (0, 0)))
+    get_near_duplicate_index().add(user_id, phash, result, frame.get("thumbnail"))
+    if (frame.get("fast_path") or {}).get("audit"):
+        log_fast_path_audit(frame["fast_path"], result, model_id)
+    scan_id = save_detection(
+        user_id, phash, result, source=frame.get("source") or ("tiled" if tiled else "single"),
+        thumbnail=frame.get("thumbnail"), deferred=deferred, image=frame.get("image"),
+        image_hash=frame.get("image_hash")
+    )
+    result["scan_id"] = scan_id
+    return result
+
+
+def _run_detection_job(job_id, user_id, upload, phash, model_id, tiled, frame):
+    _update_job(job_id, status="running", started_at=time.time())
+    try:
+        # Saved inside so the scan lands in history even if nobody polls for it
+        result = _process_scan(user_id, upload, phash, model_id, tiled, frame)
+    except Exception as e:
+        status, error = "failed", str(e)
+        if is_transient_failure(e):
+            # Endpoint unreachable: keep the scan and analyze it once the service is back
+            try:
+                spool_scan(user_id, upload, phash, model_id, tiled, frame, error)
+                status = "deferred"
+            except Exception as spool_error:
+                error = f"{e}; saving it for later also failed: {spool_error}"
+        _update_job(job_id, status=status, error=error, finished_at=time.time())
+        return
+    _update_job(job_id, status="done", result=json.dumps(result), finished_at=time.time())
+
+
+def submit_detection_job(user_id, upload, phash, model_id=MODEL_ID, tiled=False, frame=None):
+    """Queue a scan for background inference and return its job id
+
+    frame describes where the upload came from: the crop offset and
+    size of the decoded frame, and the thumbnail to keep with the scan.
+    """
+    global _job_pool
+    job_id = uuid.uuid4().hex
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO detection_jobs (id, user_id, status, created_at, owner)
+        VALUES (?, ?, 'queued', ?, ?)
+    """, (job_id, user_id, time.time(), INSTANCE_ID))
+    conn.commit()
+    conn.close()
+
+    with _job_pool_lock:
+        if _job_pool is None:
+            _job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="palay-job")
+    _job_pool.submit(_run_detection_job, job_id, user_id, upload, phash, model_id, tiled, frame or {})
+    return job_id
+
+
+def get_job(job_id):
+    """Return a job as a dict with its decoded result, or None if it does not exist"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, user_id, status, result, error, created_at, started_at, finished_at
+        FROM detection_jobs WHERE id = ?
+    """, (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "status": row[2],
+        "result": json.loads(row[3]) if row[3] else None,
+        "error": row[4],
+        "created_at": row[5],
+        "started_at": row[6],
+        "finished_at": row[7],
+    }
+
+
+def job_overdue(job):
+    """Whether a queued or running job has outlived JOB_POLL_TIMEOUT, e.g. because its process died"""
+    return job["status"] in ("queued", "running") and time.time() - job["created_at"] > JOB_POLL_TIMEOUT
+
+
+# ========== METRICS ==========
+def inference_metrics():
+    """Resilience metrics of every backend in use plus cache, coalescing and blob store counters"""
+    with _backends_lock:
+        backends = dict(_backends)
+    metrics = {name: backend.snapshot() for name, backend in backends.items()}
+    metrics["cache"] = get_cache().snapshot()
+    metrics["singleflight"] = _inflight.snapshot()
+    metrics["blobs"] = get_blob_store().snapshot()
+    with _fast_path_lock:
+        metrics["fast_path"] = dict(_fast_path_stats)
+    return metrics
+
+
+# ========== SHADOW MODEL ==========
+_shadow_pool = None
+_shadow_pending = 0
+_shadow_lock = threading.Lock()
+_shadow_backends = {}
+
+
+def init_shadow_table(db_path=DB_PATH):
+    """Table of primary vs candidate comparisons"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shadow_comparisons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            primary_model TEXT,
+            shadow_model TEXT,
+            primary_latency REAL,
+            shadow_latency REAL,
+            primary_label TEXT,
+            shadow_label TEXT,
+            top_agree INTEGER,
+            label_jaccard REAL,
+            error TEXT
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+
+def _top_label(result):
+    predictions = result.get("predictions", [])
+    if not predictions:
+        return "Healthy"
+    return max(predictions, key=lambda pred: pred["confidence"])["class"]
+
+
+def shadow_supported():
+    """Whether the configured backend can run a different model for shadow comparisons"""
+    return BACKENDS[BACKEND].selects_model
+
+
+def _shadow_backend():
+    """Separate resilient wrapper so shadow failures never trip the primary's circuit breaker"""
+    with _shadow_lock:
+        backend = _shadow_backends.get(BACKEND)
+        if backend is None:
+            backend = ResilientBackend(BACKENDS[BACKEND](), max_retries=0)
+            _shadow_backends[BACKEND] = backend
+    return backend
+
+
+def _run_shadow(data, primary_model, shadow_model, primary_result, primary_latency):
+    global _shadow_pending
+    started = time.time()
+    shadow_result, error = None, None
+    try:
+        shadow_result = _shadow_backend().infer(data, model_id=shadow_model)
+    except Exception as e:
+        error = str(e)
+    shadow_latency = time.time() - started
+
+    try:
+        primary = postprocess(primary_result)
+        primary_labels = {pred["class"] for pred in primary["predictions"]}
+        if shadow_result is not None:
+            shadow = postprocess(shadow_result)
+            shadow_labels = {pred["class"] for pred in shadow["predictions"]}
+            union = primary_labels | shadow_labels
+            row = (_top_label(primary), _top_label(shadow), int(_top_label(primary) == _top_label(shadow)),
+                   len(primary_labels & shadow_labels) / len(union) if union else 1.0)
+        else:
+            row = (_top_label(primary), None, None, None)
+
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO shadow_comparisons (
+                primary_model, shadow_model, primary_latency, shadow_latency,
+                primary_label, shadow_label, top_agree, label_jaccard, error
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (primary_model, shadow_model, primary_latency, None if error else shadow_latency, *row, error))
+        conn.commit()
+        conn.close()
+    finally:
+        with _shadow_lock:
+            _shadow_pending -= 1
+
+
+def maybe_shadow(data, model_id, result, latency):
+    """Send a sampled fraction of real scans to the candidate model, off the caller's path"""
+    global _shadow_pool, _shadow_pending
+    shadow = {**DEFAULT_SHADOW, **get_setting("shadow", {})}
+    if not shadow["model_id"] or shadow["model_id"] == model_id or random.random() >= shadow["sample_rate"]:
+        return
+    if not shadow_supported():
+        # The local model would just be compared against itself
+        return
+    with _shadow_lock:
+        # Shed samples rather than queue them up behind a slow candidate
+        if _shadow_pending >= SHADOW_MAX_PENDING:
+            return
+        _shadow_pending += 1
+        if _shadow_pool is None:
+            _shadow_pool = ThreadPoolExecutor(max_workers=SHADOW_WORKERS, thread_name_prefix="palay-shadow")
+    _shadow_pool.submit(_run_shadow, data, model_id, shadow["model_id"], result, latency)
+
+
+def shadow_report(db_path=DB_PATH):
+    """Per candidate model: sample count, agreement and latency percentiles against the primary"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT shadow_model, primary_model, primary_latency, shadow_latency, top_agree, label_jaccard, error
+        FROM shadow_comparisons
+        ORDER BY id DESC
+        LIMIT 5000
+    """)
+    rows = cursor.fetchall()
+    conn.close()
+
+    def pct(values, q):
+        return float(np.percentile(values, q)) if values else None
+
+    report = {}
+    for shadow_model, primary_model, p_lat, s_lat, agree, jaccard, error in rows:
+        entry = report.setdefault(shadow_model, {
+            "primary_model": primary_model, "samples": 0, "errors": 0,
+            "agree": [], "jaccard": [], "primary_latency": [], "shadow_latency": [],
+        })
+        entry["samples"] += 1
+        if error:
+            entry["errors"] += 1
+            continue
+        entry["agree"].append(agree)
+        entry["jaccard"].append(jaccard)
+        entry["primary_latency"].append(p_lat)
+        entry["shadow_latency"].append(s_lat)
+
+    for entry in report.values():
+        compared = len(entry["agree"])
+        entry["top_label_agreement"] = sum(entry["agree"]) / compared if compared else None
+        entry["mean_label_jaccard"] = sum(entry["jaccard"]) / compared if compared else None
+        for side in ("primary", "shadow"):
+            latencies = entry.pop(f"{side}_latency")
+            entry[f"{side}_p50"] = pct(latencies, 50)
+            entry[f"{side}_p95"] = pct(latencies, 95)
+        del entry["agree"], entry["jaccard"]
+    return report
+
+
+# ========== HEALTHY FAST PATH ==========
+_fast_path_stats = {"checked": 0, "skipped": 0, "audited": 0}
+_fast_path_lock = threading.Lock()
+
+
+def init_fast_path_table(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fast_path_audits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL,
+            model_id TEXT,
+            confidence REAL,
+            green_fraction REAL,
+            lesion_fraction REAL,
+            spot_fraction REAL,
+            model_healthy INTEGER,
+            top_class TEXT
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+
+def get_fast_path_settings():
+    """Current fast path settings, falling back to the defaults for missing keys"""
+    return {**DEFAULT_FAST_PATH, **get_setting("fast_path", {})}
+
+
+def check_fast_path(health, size):
+    """Decide whether a scan can skip remote inference
+
+    health comes from decode_scan. Returns (result, decision): result is a
+    ready "Healthy" result when the scan can be answered locally, else
+    None. A sampled fraction of scans is audited instead: it always goes
+    to the full model, and decision is passed along in the job frame so
+    the model's answer can be logged against the local score.
+    """
+    settings = get_fast_path_settings()
+    confidence = healthy_confidence(health)
+    audit = random.random() < settings["audit_rate"]
+    skip = settings["enabled"] and confidence >= settings["threshold"] and not audit
+    with _fast_path_lock:
+        _fast_path_stats["checked"] += 1
+        _fast_path_stats["skipped"] += skip
+        _fast_path_stats["audited"] += audit
+
+    decision = {"confidence": confidence, "audit": audit, **health}
+    if not skip:
+        return None, decision
+    width, height = size
+    return {"image": {"width": width, "height": height}, "predictions": [], "fast_path": confidence}, decision
+
+
+def log_fast_path_audit(decision, result, model_id, db_path=DB_PATH):
+    """Record the local score next to what the full model found, after post-processing"""
+    predictions = result.get("predictions", [])
+    top = max(predictions, key=lambda pred: pred["confidence"])["class"] if predictions else None
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO fast_path_audits (created_at, model_id, confidence, green_fraction, lesion_fraction,
+                                      spot_fraction, model_healthy, top_class)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        time.time(), model_id, decision["confidence"], decision["green_fraction"],
+        decision["lesion_fraction"], decision["spot_fraction"], int(not predictions), top,
+    ))
+    conn.commit()
+    conn.close()
+
+
+def fast_path_report(thresholds=FAST_PATH_THRESHOLDS, db_path=DB_PATH):
+    """Calibration of the fast path against the full model
+
+    For each candidate threshold: how many audited scans would have been
+    answered locally (coverage) and how often the full model agreed they
+    were healthy. recommended is the lowest threshold at which it and
+    every higher one reach FAST_PATH_TARGET_AGREEMENT; thresholds with
+    fewer than FAST_PATH_MIN_SAMPLES skipped scans are not judged.
+    """
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT confidence, model_healthy FROM fast_path_audits ORDER BY id DESC LIMIT 5000")
+    rows = cursor.fetchall()
+    conn.close()
+    if not rows:
+        return {"samples": 0, "thresholds": [], "recommended": None}
+
+    audits = np.array(rows, dtype=np.float64)
+    confidence, healthy = audits[:, 0], audits[:, 1]
+    table = []
+    for threshold in thresholds:
+        selected = confidence >= threshold
+        count = int(selected.sum())
+        agreement = float(healthy[selected].mean()) if count else None
+        table.append({
+            "threshold": threshold,
+            "skipped": count,
+            "coverage": count / len(audits),
+            "agreement": agreement,
+            "missed_disease": int(count - healthy[selected].sum()),
+        })
+
+    recommended = None
+    for row in reversed(table):
+        if row["skipped"] < FAST_PATH_MIN_SAMPLES:
+            continue
+        if row["agreement"] < FAST_PATH_TARGET_AGREEMENT:
+            break
+        recommended = row["threshold"]
+    return {"samples": len(audits), "thresholds": table, "recommended": recommended}
+
+
+# ========== OFFLINE SPOOL ==========
+def init_spool_table(db_path=DB_PATH):
+    """Queue table for scans waiting in the spool directory"""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS spool_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            path TEXT,
+            phash TEXT,
+            model_id TEXT,
+            tiled INTEGER,
+            frame TEXT,
+            thumbnail BLOB,
+            image_hash TEXT,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at REAL
+        )
+    """)
+    for column in ("image_hash TEXT", "claimed_at REAL"):
+        try:
+            cursor.execute(f"ALTER TABLE spool_queue ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            # Column already exists
+            pass
+    conn.commit()
+    conn.close()
+
+
+def spool_scan(user_id, upload, phash, model_id, tiled, frame, error=None, db_path=DB_PATH):
+    """Persist a scan that could not be analyzed now; the drainer retries it later"""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    # Content-addressed, so spooling the same photo twice keeps one file
+    path = os.path.join(SPOOL_DIR, content_hash(upload) + ".img")
+    if not os.path.exists(path):
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(upload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    meta = {
+        "offset": list(frame.get("offset", (0, 0))),
+        "size": list(frame["size"]) if frame.get("size") else None,
+        "fast_path": frame.get("fast_path"),
+        "source": frame.get("source"),
+    }
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO spool_queue (user_id, path, phash, model_id, tiled, frame, thumbnail, image_hash,
+                                 next_attempt_at, last_error, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        user_id, path, f"{phash:064x}" if phash is not None else None, model_id, int(tiled), json.dumps(meta),
+        frame.get("thumbnail"), frame.get("image_hash"), time.time() + SPOOL_BACKOFF_BASE, error, time.time(),
+    ))
+    item_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    # Archive the original in the background; only the inference payload waits in the spool directory
+    if frame.get("image"):
+        archive_scan_images([(item_id, frame["image"])], db_path, table="spool_queue")
+
+
+def _claim_spooled(db_path=DB_PATH):
+    """Atomically take the next due item, so several server processes can drain together
+
+    A claim is a lease: items left 'running' by a drainer that died are
+    picked up again once SPOOL_LEASE has passed, never while it may still
+    be working on them.
+    """
+    now = time.time()
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, user_id, path, phash, model_id, tiled, frame, thumbnail, image_hash, attempts, status, claimed_at
+        FROM spool_queue
+        WHERE (status = 'queued' AND next_attempt_at <= ?)
+           OR (status = 'running' AND (claimed_at IS NULL OR claimed_at < ?))
+        ORDER BY next_attempt_at
+        LIMIT 1
+    """, (now, now - SPOOL_LEASE))
+    row = cursor.fetchone()
+    if row is not None:
+        # Only succeeds if nobody claimed or renewed the item since we read it
+        cursor.execute("""
+            UPDATE spool_queue SET status = 'running', claimed_at = ?
+            WHERE id = ? AND status = ? AND claimed_at IS ?
+        """, (now, row[0], row[10], row[11]))
+        row = row[:10] if cursor.rowcount else None
+    conn.commit()
+    conn.close()
+    return row
+
+
+def _drain_one(db_path=DB_PATH):
+    """Process one due spool item; returns False when nothing was due or the endpoint is still down"""
+    row = _claim_spooled(db_path)
+    if row is None:
+        return False
+    item_id, user_id, path, phash_hex, model_id, tiled, frame_json, thumbnail, image_hash, attempts = row
+    frame = json.loads(frame_json)
+    frame["thumbnail"] = thumbnail
+    frame["image_hash"] = image_hash
+    try:
+        with open(path, "rb") as f:
+            upload = f.read()
+        phash = int(phash_hex, 16) if phash_hex else None
+        _process_scan(user_id, upload, phash, model_id, bool(tiled), frame, deferred=True)
+    except Exception as e:
+        attempts += 1
+        retryable = is_transient_failure(e)
+        status = "queued" if retryable and attempts < SPOOL_MAX_ATTEMPTS else "failed"
+        delay = min(SPOOL_BACKOFF_MAX, SPOOL_BACKOFF_BASE * 2 ** attempts) * random.uniform(0.5, 1.0)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE spool_queue SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+            WHERE id = ?
+        """, (status, attempts, time.time() + delay, str(e), item_id))
+        conn.commit()
+        conn.close()
+        return False
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM spool_queue WHERE id = ?", (item_id,))
+    cursor.execute("SELECT COUNT(*) FROM spool_queue WHERE path = ?", (path,))
+    still_used = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    if not still_used:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return True
+
+
+def _spool_worker():
+    while True:
+        try:
+            # Keep draining while items succeed, then sleep until the next poll
+            while _drain_one():
+                pass
+        except Exception as e:
+            print("Spool drain failed:", e)
+        time.sleep(SPOOL_POLL)
+
+
+_spool_started = False
+
+
+def start_spool_worker():
+    """Start the background drainer once per process"""
+    global _spool_started
+    with _sweeper_lock:
+        if _spool_started:
+            return
+        _spool_started = True
+    threading.Thread(target=_spool_worker, daemon=True, name="palay-spool").start()
+
+
+def spool_stats(db_path=DB_PATH):
+    """Spooled scans by status"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM spool_queue GROUP BY status")
+    stats = dict(cursor.fetchall())
+    conn.close()
+    return stats
@@ -0,0 +1,662 @@
+# ========== IMPORTS ==========
+import io
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Pure image helpers used by the detect page. Nothing here touches the
+# network or the database.
+
+# ========== CONFIG ==========
+UPLOAD_MAX_SIDE = int(os.environ.get("PALAY_UPLOAD_MAX_SIDE", "1024"))
+UPLOAD_FORMAT = os.environ.get("PALAY_UPLOAD_FORMAT", "JPEG").upper()
+UPLOAD_QUALITY = int(os.environ.get("PALAY_UPLOAD_QUALITY", "85"))
+UPLINK_KBPS = float(os.environ.get("PALAY_UPLINK_KBPS", "1000"))
+
+THUMBNAIL_SIDE = int(os.environ.get("PALAY_THUMBNAIL_SIDE", "320"))
+THUMBNAIL_FORMAT = os.environ.get("PALAY_THUMBNAIL_FORMAT", "WEBP").upper()
+THUMBNAIL_QUALITY = int(os.environ.get("PALAY_THUMBNAIL_QUALITY", "70"))
+
+# Near-duplicate scans: 16x16 (256-bit) dHash candidates, confirmed on the thumbnails once
+# they are registered onto each other, so a hand-held re-shot still matches
+SCAN_HASH_SIZE = 16
+MATCH_PYRAMID_LEVELS = 3
+MATCH_MIN_CORRELATION = 0.9
+MATCH_MIN_OVERLAP = 0.7
+MATCH_BORDER = 11
+MATCH_SHADING_SIGMA = 12
+MATCH_PIXEL_DELTA = 22
+MATCH_MAX_CHANGED = 3
+
+# Quality gate, measured on a QUALITY_SIDE px grayscale copy so thresholds do not depend on resolution
+QUALITY_SIDE = 512
+BLUR_THRESHOLD = float(os.environ.get("PALAY_BLUR_THRESHOLD", "60"))
+CLIP_FRACTION = float(os.environ.get("PALAY_CLIP_FRACTION", "0.35"))
+DARK_MEAN = 40
+BRIGHT_MEAN = 225
+
+# Leaf region-of-interest crop
+LEAF_CROP = os.environ.get("PALAY_LEAF_CROP", "1") == "1"
+ROI_SIDE = 256
+ROI_PADDING = float(os.environ.get("PALAY_ROI_PADDING", "0.08"))
+ROI_MIN_FRACTION = 0.05
+ROI_MAX_AREA = 0.85
+EXG_THRESHOLD = 0.05
+
+# Local "obviously healthy" check, computed on a HEALTH_SIDE px copy of the leaf crop
+HEALTH_SIDE = 256
+HEALTH_MIN_LEAF = 0.2
+HEALTH_LESION_SCALE = 0.02
+HEALTH_SPOT_SCALE = 0.03
+SPOT_DEPTH = 25
+
+# Lesion-area severity inside predicted boxes, measured on a SEVERITY_SIDE px copy
+SEVERITY_SIDE = int(os.environ.get("PALAY_SEVERITY_SIDE", "512"))
+
+# Tiled analysis of wide canopy shots
+TILED_MAX_SIDE = int(os.environ.get("PALAY_TILED_MAX_SIDE", "3072"))
+TILE_SIZE = int(os.environ.get("PALAY_TILE_SIZE", "640"))
+TILE_OVERLAP = float(os.environ.get("PALAY_TILE_OVERLAP", "0.2"))
+NMS_IOU = float(os.environ.get("PALAY_NMS_IOU", "0.5"))
+
+# Archived scan images: the full rendition plus pre-generated smaller tiers
+ARCHIVE_FORMAT = os.environ.get("PALAY_ARCHIVE_FORMAT", "WEBP").upper()
+ARCHIVE_QUALITY = int(os.environ.get("PALAY_ARCHIVE_QUALITY", "80"))
+ARCHIVE_MAX_SIDE = int(os.environ.get("PALAY_ARCHIVE_MAX_SIDE", "2048"))
+ARCHIVE_TIERS = {"preview": 640, "thumb": 160}
+
+# Field walk videos
+VIDEO_MAX_FRAMES = int(os.environ.get("PALAY_VIDEO_MAX_FRAMES", "60"))
+VIDEO_DEDUP_DISTANCE = int(os.environ.get("PALAY_VIDEO_DEDUP_DISTANCE", "8"))
+MOTION_PROBE = 0.25
+MOTION_THRESHOLD = 12
+
+
+# ========== PERCEPTUAL HASH ==========
+def dhash(image, hash_size=8):
+    """hash_size**2-bit difference hash of a PIL image, returned as an int"""
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    """Number of differing bits between two integer hashes"""
+    return bin(a ^ b).count("1")
+
+
+def _register(first, second, levels=MATCH_PYRAMID_LEVELS):
+    """Affine warp taking pixel coordinates of second to first, and its ECC correlation
+
+    Phase correlation on the coarsest pyramid level finds the shift, and
+    ECC refines it level by level into an affine map, which covers the
+    small turn and zoom between two hand-held shots. Raises cv2.error
+    when ECC does not converge.
+    """
+    pyramid = [(cv2.cvtColor(first, cv2.COLOR_BGR2GRAY).astype(np.float32),
+                cv2.cvtColor(second, cv2.COLOR_BGR2GRAY).astype(np.float32))]
+    for _ in range(levels - 1):
+        pyramid.append(tuple(cv2.pyrDown(gray) for gray in pyramid[-1]))
+
+    coarse_first, coarse_second = pyramid[-1]
+    height, width = coarse_second.shape
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(coarse_second, coarse_first, window)
+    warp = np.float32([[1, 0, dx], [0, 1, dy]])
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+    correlation = 0.0
+    for level in range(levels - 1, -1, -1):
+        gray_first, gray_second = pyramid[level]
+        correlation, warp = cv2.findTransformECC(gray_second, gray_first, warp, cv2.MOTION_AFFINE, criteria, None, 5)
+        if level:
+            warp[:, 2] *= 2
+    return warp, correlation
+
+
+def match_thumbnails(a, b, min_correlation=MATCH_MIN_CORRELATION, min_overlap=MATCH_MIN_OVERLAP,
+                     border=MATCH_BORDER, shading_sigma=MATCH_SHADING_SIGMA, pixel_delta=MATCH_PIXEL_DELTA,
+                     max_changed=MATCH_MAX_CHANGED):
+    """How the picture moved from thumbnail a to thumbnail b, or None if they are not the same picture
+
+    A perceptual hash barely moves when a few lesions appear, so a hash
+    match is only a candidate. a is registered onto b, and where they
+    overlap (at least min_overlap of the frame, less a border of
+    unreliable pixels) local brightness is evened out so exposure and
+    vignetting do not count. A pixel has changed when it differs by more
+    than pixel_delta from every pixel of the other thumbnail within one
+    pixel, which absorbs what is left of the misalignment; at most
+    max_changed may, and only in clusters of at least 2x2, so JPEG noise
+    is ignored and a single small lesion is not.
+
+    The returned 2x3 affine map takes a point of a, as fractions of the
+    frame width and height, to the same point of b.
+    """
+    if a is None or b is None:
+        return None
+    first = cv2.imdecode(np.frombuffer(a, np.uint8), cv2.IMREAD_COLOR)
+    second = cv2.imdecode(np.frombuffer(b, np.uint8), cv2.IMREAD_COLOR)
+    if first is None or second is None or first.shape != second.shape:
+        return None
+    try:
+        warp, correlation = _register(first, second)
+    except cv2.error:
+        return None
+    if correlation < min_correlation:
+        return None
+
+    height, width = second.shape[:2]
+    flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+    aligned = cv2.warpAffine(first, warp, (width, height), flags=flags).astype(np.float32)
+    valid = cv2.warpAffine(np.ones((height, width), np.uint8), warp, (width, height),
+                           flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+    valid = cv2.erode(valid, np.ones((border, border), np.uint8)).astype(bool)
+    if valid.mean() < min_overlap:
+        return None
+
+    second = second.astype(np.float32)
+    weight = valid.astype(np.float32)
+    coverage = np.maximum(cv2.GaussianBlur(weight, (0, 0), shading_sigma), 1e-3)[..., None]
+    shading_first = cv2.GaussianBlur(aligned * weight[..., None], (0, 0), shading_sigma) / coverage
+    shading_second = cv2.GaussianBlur(second * weight[..., None], (0, 0), shading_sigma) / coverage
+    aligned *= shading_second / np.maximum(shading_first, 1)
+    aligned = cv2.GaussianBlur(aligned, (0, 0), 1)
+    second = cv2.GaussianBlur(second, (0, 0), 1)
+
+    kernel = np.ones((3, 3), np.uint8)
+    diff = np.maximum.reduce([
+        aligned - cv2.dilate(second, kernel), cv2.erode(second, kernel) - aligned,
+        second - cv2.dilate(aligned, kernel), cv2.erode(aligned, kernel) - second,
+    ]).max(axis=2)
+    changed = ((diff > pixel_delta) & valid).astype(np.uint8)
+    changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+    if int(changed.sum()) > max_changed:
+        return None
+
+    # Pixels of a to pixels of b, then the same map in fractions of the frame
+    motion = cv2.invertAffineTransform(warp).astype(np.float64)
+    motion[0, 1] *= height / width
+    motion[1, 0] *= width / height
+    motion[0, 2] /= width
+    motion[1, 2] /= height
+    return motion
+
+
+# ========== QUALITY GATE ==========
+class PhotoQualityError(Exception):
+    """A photo failed the blur/exposure check and should be retaken"""
+
+
+def check_quality(pixels):
+    """Sharpness and exposure check on an RGB array
+
+    Returns (ok, reason, stats). Sharpness is the variance of the
+    Laplacian; exposure looks at how much of the histogram is clipped at
+    either end and at the mean brightness.
+    """
+    gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    height, width = gray.shape
+    scale = QUALITY_SIDE / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel() / gray.size
+    dark = float(hist[:8].sum())
+    bright = float(hist[248:].sum())
+    mean = float(gray.mean())
+    stats = {"sharpness": sharpness, "dark_fraction": dark, "bright_fraction": bright, "brightness": mean}
+
+    if dark > CLIP_FRACTION or mean < DARK_MEAN:
+        return False, "The photo is too dark. Please retake it in better light.", stats
+    if bright > CLIP_FRACTION or mean > BRIGHT_MEAN:
+        return False, "The photo is overexposed. Please retake it out of direct glare.", stats
+    if sharpness < BLUR_THRESHOLD:
+        return False, "The photo is blurry. Hold the phone steady and retake it.", stats
+    return True, None, stats
+
+
+# ========== LEAF REGION OF INTEREST ==========
+def leaf_mask(pixels):
+    """Boolean mask of leaf-coloured pixels (green or yellowing) in an RGB array"""
+    rgb = pixels.astype(np.float32)
+    total = rgb.sum(axis=2) + 1e-6
+    # Excess-green index on chromatic coordinates: 2g - r - b
+    exg = (2 * rgb[..., 1] - rgb[..., 0] - rgb[..., 2]) / total
+
+    hsv = cv2.cvtColor(pixels, cv2.COLOR_RGB2HSV)
+    hue, sat, val = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    # OpenCV hue is 0-179; 22-90 covers yellow through green, which keeps chlorotic leaves
+    # while leaving out brown soil
+    leafy_hue = (hue >= 22) & (hue <= 90) & (sat >= 40) & (val >= 40)
+    return (exg > EXG_THRESHOLD) | leafy_hue
+
+
+def leaf_roi(pixels, padding=ROI_PADDING):
+    """Padded (left, top, right, bottom) box around the leaf, or None to keep the full frame
+
+    The mask is computed on a ROI_SIDE px copy. Bounds use the 1st/99th
+    percentile of mask coordinates so stray green specks do not stretch
+    the box. None is returned when too little of the frame looks like a
+    leaf, or when the box would cover nearly the whole frame anyway.
+    """
+    height, width = pixels.shape[:2]
+    scale = min(ROI_SIDE / max(height, width), 1.0)
+    small = cv2.resize(pixels, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+
+    # Opening removes isolated speckles from noisy or textured backgrounds
+    mask = leaf_mask(small).astype(np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8)).astype(bool)
+    if mask.mean() < ROI_MIN_FRACTION:
+        return None
+
+    ys, xs = np.nonzero(mask)
+    x0, x1 = np.percentile(xs, [1, 99]) / scale
+    y0, y1 = np.percentile(ys, [1, 99]) / scale
+    pad_x = (x1 - x0) * padding
+    pad_y = (y1 - y0) * padding
+    left = int(max(x0 - pad_x, 0))
+    top = int(max(y0 - pad_y, 0))
+    right = int(min(x1 + pad_x + 1, width))
+    bottom = int(min(y1 + pad_y + 1, height))
+
+    if (right - left) * (bottom - top) > ROI_MAX_AREA * width * height:
+        return None
+    return left, top, right, bottom
+
+
+# ========== HEALTHY FAST PATH ==========
+def _downscale(pixels, side):
+    """INTER_AREA copy at most side px on its longest side, and the scale used"""
+    height, width = pixels.shape[:2]
+    scale = min(side / max(height, width), 1.0)
+    if scale == 1.0:
+        return pixels, scale
+    small = cv2.resize(pixels, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+    return small, scale
+
+
+def _leaf_colours(small):
+    """Green and lesion-coloured (brown, yellow or bleached) masks of an RGB array"""
+    hsv = cv2.cvtColor(small, cv2.COLOR_RGB2HSV)
+    hue, sat, val = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    green = (hue >= 35) & (hue <= 90) & (sat >= 40) & (val >= 40)
+    brown = ((hue < 22) | (hue >= 165)) & (sat >= 60) & (val >= 30)
+    yellow = (hue >= 22) & (hue < 35) & (sat >= 80) & (val >= 80)
+    bleached = (sat < 35) & (val >= 170)
+    return green, brown | yellow | bleached
+
+
+def _leaf_region(green, size):
+    """Green area with holes and notches up to size px closed, so lesions inside it count as leaf"""
+    kernel = np.ones((size, size), np.uint8)
+    return cv2.morphologyEx(green.astype(np.uint8), cv2.MORPH_CLOSE, kernel).astype(bool)
+
+
+def health_stats(pixels):
+    """Colour and texture statistics of a leaf crop for the local healthy check
+
+    The leaf region is the green area with holes and notches closed, so
+    lesions inside it still count. Within that region we measure the
+    share of green pixels, of lesion-coloured ones (brown, yellow or
+    bleached) and of small dark spots that stand out from their
+    neighbourhood in the green channel. Fractions are of region pixels.
+    """
+    small, _ = _downscale(pixels, HEALTH_SIDE)
+    green, lesion = _leaf_colours(small)
+    region = _leaf_region(green, 15)
+    region_pixels = int(region.sum())
+    if region_pixels == 0:
+        return {"leaf_fraction": 0.0, "green_fraction": 0.0, "lesion_fraction": 0.0, "spot_fraction": 0.0}
+    lesion &= region
+
+    leaf_green = small[..., 1].astype(np.float32)
+    spots = (cv2.blur(leaf_green, (7, 7)) - leaf_green > SPOT_DEPTH) & region
+    return {
+        "leaf_fraction": region_pixels / region.size,
+        "green_fraction": float((green & region).sum()) / region_pixels,
+        "lesion_fraction": float(lesion.sum()) / region_pixels,
+        "spot_fraction": float(spots.sum()) / region_pixels,
+    }
+
+
+def healthy_confidence(stats):
+    """0-1 score that a leaf is healthy, from health_stats
+
+    Falls off exponentially with lesion and spot fractions, so a couple of
+    percent of lesion pixels is already enough to send the scan to the
+    full model. Photos without enough leaf in them score 0.
+    """
+    if stats["leaf_fraction"] < HEALTH_MIN_LEAF:
+        return 0.0
+    penalty = stats["lesion_fraction"] / HEALTH_LESION_SCALE + stats["spot_fraction"] / HEALTH_SPOT_SCALE
+    return float(stats["green_fraction"] * np.exp(-penalty))
+
+
+# ========== SEVERITY ==========
+def lesion_severity(pixels, predictions, offset=(0, 0), pixel_scale=1.0, side=SEVERITY_SIDE):
+    """Percent of the leaf area covered by lesions inside the predicted boxes
+
+    pixels is the RGB array the boxes were drawn on, or a crop of it that
+    starts at offset (boxes are in frame coordinates, see
+    to_frame_coordinates), possibly decoded at pixel_scale of that size.
+    Lesion pixels are lesion-coloured pixels inside
+    a box and near the leaf, so brown soil caught in a box's corner is not
+    counted; the leaf is the closed green region plus those lesions.
+    Returns {"percent", "by_class": {class: percent}} or None when no leaf
+    is visible.
+    """
+    small, scale = _downscale(pixels, side)
+    scale *= pixel_scale
+    height, width = small.shape[:2]
+    # Kernels grow with the working resolution so the result does not depend on it
+    close_size = max(int(round(max(height, width) / 17)) | 1, 3)
+    green, lesion_colour = _leaf_colours(small)
+    region = _leaf_region(green, close_size)
+    near_leaf = cv2.dilate(region.astype(np.uint8), np.ones((close_size, close_size), np.uint8)).astype(bool)
+
+    boxes_by_class = {}
+    for pred in predictions:
+        left = int(max((pred["x"] - pred["width"] / 2 - offset[0]) * scale, 0))
+        top = int(max((pred["y"] - pred["height"] / 2 - offset[1]) * scale, 0))
+        right = int(min(np.ceil((pred["x"] + pred["width"] / 2 - offset[0]) * scale), width))
+        bottom = int(min(np.ceil((pred["y"] + pred["height"] / 2 - offset[1]) * scale), height))
+        if right <= left or bottom <= top:
+            continue
+        mask = boxes_by_class.setdefault(pred["class"], np.zeros((height, width), bool))
+        mask[top:bottom, left:right] = True
+
+    candidates = lesion_colour & near_leaf
+    lesion = np.zeros((height, width), bool)
+    class_lesions = {}
+    for name, mask in boxes_by_class.items():
+        class_lesion = candidates & mask
+        class_lesions[name] = class_lesion
+        lesion |= class_lesion
+
+    leaf_pixels = int((region | lesion).sum())
+    if leaf_pixels == 0:
+        return None
+    return {
+        "percent": round(100.0 * float(lesion.sum()) / leaf_pixels, 2),
+        "by_class": {
+            name: round(100.0 * float(class_lesion.sum()) / leaf_pixels, 2)
+            for name, class_lesion in class_lesions.items()
+        },
+    }
+
+
+def upload_severity(data, predictions, offset=(0, 0), side=SEVERITY_SIDE):
+    """lesion_severity of an encoded inference payload, decoded straight to about side px"""
+    image = Image.open(io.BytesIO(data))
+    full_width = image.size[0]
+    image.draft("RGB", (side, side))
+    pixels = np.asarray(image.convert("RGB"))
+    return lesion_severity(pixels, predictions, offset, pixel_scale=pixels.shape[1] / full_width, side=side)
+
+
+# ========== TILING ==========
+def _tile_starts(length, tile, step):
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, step))
+    # Last tile sits flush with the far edge so nothing is cut off
+    starts.append(length - tile)
+    return starts
+
+
+def tile_boxes(width, height, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """(left, top, right, bottom) of overlapping tiles covering the whole image"""
+    step = max(int(tile * (1 - overlap)), 1)
+    return [
+        (x, y, min(x + tile, width), min(y + tile, height))
+        for y in _tile_starts(height, tile, step)
+        for x in _tile_starts(width, tile, step)
+    ]
+
+
+def nms(boxes, scores, labels, iou_threshold=NMS_IOU):
+    """Class-aware non-maximum suppression; returns indices of the boxes to keep
+
+    boxes is an (N, 4) array of left, top, right, bottom. Shifting each
+    class into its own coordinate range means boxes of different classes
+    can never overlap, so one greedy pass handles every class at once.
+    """
+    if len(boxes) == 0:
+        return []
+    _, class_ids = np.unique(labels, return_inverse=True)
+    shifted = boxes + (class_ids * (boxes.max() + 1))[:, None]
+    x0, y0, x1, y1 = shifted.T
+    areas = (x1 - x0) * (y1 - y0)
+
+    order = np.argsort(scores)[::-1]
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(int(best))
+        width = np.clip(np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest]), 0, None)
+        height = np.clip(np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest]), 0, None)
+        inter = width * height
+        iou = inter / (areas[best] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return keep
+
+
+# ========== VIDEO SAMPLING ==========
+def sample_video_frames(path, every=1.0, motion=False, max_frames=VIDEO_MAX_FRAMES,
+                        max_side=UPLOAD_MAX_SIDE, dedup_distance=VIDEO_DEDUP_DISTANCE, stats=None):
+    """Yield (seconds, rgb_pixels, dhash) for distinct frames of a video, reading it as a stream
+
+    Frames are taken every `every` seconds, or with motion=True whenever
+    the picture has moved enough since the last kept frame. Skipped
+    frames are only grabbed, never converted, and a frame within
+    dedup_distance bits of one already kept is dropped.
+
+    When the frame count is known, sampling is stretched so that
+    max_frames cover the whole video rather than just its beginning. If
+    a dict is passed as stats, it receives the video's duration and the
+    seconds actually covered, with truncated set when frames ran out
+    before the end.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError("Could not read this video.")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    step = max(int(round(fps * (MOTION_PROBE if motion else every))), 1)
+    # Fewest frames between two kept ones so max_frames reach the end of the video
+    min_gap = frame_count // max_frames if frame_count > 0 else 0
+    if not motion:
+        step = max(step, min_gap)
+    stats = {} if stats is None else stats
+    stats.update(duration=frame_count / fps if frame_count > 0 else None, covered=0.0, truncated=False)
+
+    kept_hashes = []
+    last_small = None
+    last_kept = None
+    index = -1
+    try:
+        while True:
+            if not capture.grab():
+                break
+            index += 1
+            stats["covered"] = index / fps
+            if index % step or (last_kept is not None and index - last_kept < min_gap):
+                continue
+            if len(kept_hashes) >= max_frames:
+                stats["truncated"] = True
+                break
+            ok, frame = capture.retrieve()
+            if not ok:
+                continue
+
+            if motion:
+                small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 36), interpolation=cv2.INTER_AREA)
+                small = small.astype(np.int16)
+                if last_small is not None and np.abs(small - last_small).mean() < MOTION_THRESHOLD:
+                    continue
+                last_small = small
+
+            height, width = frame.shape[:2]
+            scale = max_side / max(height, width)
+            if scale < 1:
+                frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+            frame_hash = dhash(Image.fromarray(rgb))
+            if any(hamming(frame_hash, seen) <= dedup_distance for seen in kept_hashes):
+                continue
+            kept_hashes.append(frame_hash)
+            last_kept = index
+            yield index / fps, rgb, frame_hash
+    finally:
+        capture.release()
+
+
+# ========== DETECTION OVERLAY ==========
+def _class_colour(name):
+    """Stable BGR colour per disease name"""
+    seed = sum(ord(ch) * (i + 1) for i, ch in enumerate(name))
+    hue = seed % 180
+    bgr = cv2.cvtColor(np.uint8([[[hue, 200, 230]]]), cv2.COLOR_HSV2BGR)[0, 0]
+    return tuple(int(c) for c in bgr)
+
+
+def draw_predictions(image_bytes, result, quality=85):
+    """Draw labelled boxes on an encoded image and return it as JPEG bytes
+
+    Boxes are in the coordinates of result["image"] and are scaled to
+    whatever size image_bytes happens to be (usually a thumbnail).
+    """
+    canvas = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    height, width = canvas.shape[:2]
+    frame = result.get("image") or {}
+    scale_x = width / (frame.get("width") or width)
+    scale_y = height / (frame.get("height") or height)
+    thickness = max(1, round(max(width, height) / 300))
+
+    for pred in result.get("predictions", []):
+        colour = _class_colour(pred["class"])
+        left = int((pred["x"] - pred["width"] / 2) * scale_x)
+        top = int((pred["y"] - pred["height"] / 2) * scale_y)
+        right = int((pred["x"] + pred["width"] / 2) * scale_x)
+        bottom = int((pred["y"] + pred["height"] / 2) * scale_y)
+        cv2.rectangle(canvas, (left, top), (right, bottom), colour, thickness)
+
+        label = f"{pred['class']} {pred['confidence'] * 100:.0f}%"
+        font_scale = 0.35 * thickness
+        (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 1)
+        label_top = max(top - text_h - baseline - 2, 0)
+        cv2.rectangle(canvas, (left, label_top), (left + text_w + 4, label_top + text_h + baseline + 2), colour, -1)
+        cv2.putText(canvas, label, (left + 2, label_top + text_h + 1), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale, (255, 255, 255), 1, cv2.LINE_AA)
+
+    ok, encoded = cv2.imencode(".jpg", canvas, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return encoded.tobytes()
+
+
+# ========== UPLOAD PREPROCESSING ==========
+def encode(image, fmt=UPLOAD_FORMAT, quality=UPLOAD_QUALITY):
+    """Encode a PIL image to bytes in the given format"""
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def make_thumbnail(image, side=THUMBNAIL_SIDE, fmt=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY):
+    """Small lossy thumbnail of a PIL image, cheap enough to embed inline in HTML"""
+    thumb = image.copy()
+    thumb.thumbnail((side, side), Image.BILINEAR)
+    return encode(thumb, fmt, quality)
+
+
+def thumbnail_mime(fmt=THUMBNAIL_FORMAT):
+    """MIME type for a data: URL holding a thumbnail"""
+    return "image/webp" if fmt == "WEBP" else "image/jpeg"
+
+
+ARCHIVE_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+
+
+def archive_extension(fmt=ARCHIVE_FORMAT):
+    """File extension for an archived image in the given format"""
+    return ARCHIVE_EXTENSIONS.get(fmt, fmt.lower())
+
+
+def archive_mime(fmt=ARCHIVE_FORMAT):
+    """MIME type of an archived image in the given format"""
+    return f"image/{'jpeg' if fmt == 'JPEG' else fmt.lower()}"
+
+
+def decode_scan(data, max_side=UPLOAD_MAX_SIDE, fmt=UPLOAD_FORMAT, quality=UPLOAD_QUALITY, crop=LEAF_CROP):
+    """Decode an upload once and derive everything the detect page needs from it
+
+    The image is decoded a single time, at most max_side pixels on its
+    longest side, and the thumbnail, perceptual hash, quality check, leaf
+    crop and inference payload are all produced from that one decoded array.
+    """
+    image = Image.open(io.BytesIO(data))
+    original_size = image.size
+    # For JPEGs, draft() lets the decoder skip straight to a reduced DCT scale
+    image.draft("RGB", (max_side, max_side))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    pixels = np.asarray(image)
+    roi = leaf_roi(pixels) if crop else None
+
+    upload = encode(image.crop(roi) if roi else image, fmt, quality)
+    # Never send something bigger than what the farmer uploaded
+    if roi is None and len(upload) >= len(data) and max(original_size) <= max_side:
+        upload = data
+
+    quality_ok, quality_reason, quality_stats = check_quality(pixels)
+    leaf = pixels[roi[1]:roi[3], roi[0]:roi[2]] if roi else pixels
+    return {
+        "pixels": pixels,
+        # Box coordinates from inference are relative to this crop of pixels
+        "roi": roi,
+        "quality_ok": quality_ok,
+        "quality_reason": quality_reason,
+        "quality": quality_stats,
+        "health": health_stats(leaf),
+        "size": image.size,
+        "original_size": original_size,
+        "original_bytes": len(data),
+        "upload": upload,
+        "upload_bytes": len(upload),
+        "phash": dhash(image, SCAN_HASH_SIZE),
+        "thumbnail": make_thumbnail(image),
+    }
+
+
+def upload_savings(info, uplink_kbps=UPLINK_KBPS):
+    """Bytes saved by preprocessing and the upload seconds that saves on the given uplink"""
+    saved = max(info["original_bytes"] - info["upload_bytes"], 0)
+    return saved, saved * 8 / (uplink_kbps * 1000)
+
+
+def archive_renditions(data, max_side=ARCHIVE_MAX_SIDE, tiers=ARCHIVE_TIERS,
+                       fmt=ARCHIVE_FORMAT, quality=ARCHIVE_QUALITY):
+    """Recompress an upload for archiving and derive every thumbnail tier from one decode
+
+    Returns {"full": bytes, <tier>: bytes, ...} plus the stored width and
+    height. Tiers are downscaled from the previous, larger one, so each
+    resize only touches as many pixels as it needs to.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (max_side, max_side))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    renditions = {"full": encode(image, fmt, quality)}
+    width, height = image.size
+    for name, side in sorted(tiers.items(), key=lambda tier: -tier[1]):
+        image = image.copy()
+        image.thumbnail((side, side), Image.LANCZOS)
+        renditions[name] = encode(image, fmt, quality)
+    return renditions, width, height
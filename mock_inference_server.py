@@ -0,0 +1,180 @@
+# ========== MOCK INFERENCE SERVER ==========
+# Local stand-in for the hosted detection endpoint, for benchmarking the
+# scan flow without paying for (or waiting on) real inference.
+#
+#   python mock_inference_server.py --port 9001 --latency lognormal --mean 0.4 --error-rate 0.02
+#   PALAY_API_URL=http://localhost:9001 streamlit run app.py
+#
+# It answers POST /<project>/<version>?api_key=... with the same
+# predictions JSON the hosted API returns. Predictions are seeded from the
+# image bytes, so the same image always gets the same answer.
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+CLASSES = [
+    "Bacterial Leaf Blight", "Brown Spot", "Leaf Blast", "Leaf Scald",
+    "Narrow Brown Leaf Spot", "Rice Hispa", "Sheath Blight", "Rice Tungro",
+]
+
+
+class MockSettings:
+    """Latency, error and payload knobs shared by every request handler"""
+
+    def __init__(self, args):
+        self.latency = args.latency
+        self.mean = args.mean
+        self.spread = args.spread
+        self.error_rate = args.error_rate
+        self.max_predictions = args.max_predictions
+        self.empty_rate = args.empty_rate
+        self.padding = args.padding
+        self.seed = args.seed
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def next_delay_and_error(self):
+        """Draw this request's latency and whether it should fail"""
+        with self.lock:
+            self.requests += 1
+            if self.latency == "fixed":
+                delay = self.mean
+            elif self.latency == "uniform":
+                delay = self.rng.uniform(max(self.mean - self.spread, 0), self.mean + self.spread)
+            else:
+                # Lognormal with the requested mean; spread is sigma of the underlying normal
+                mu = math.log(max(self.mean, 1e-6)) - self.spread ** 2 / 2
+                delay = self.rng.lognormvariate(mu, self.spread)
+            fail = self.rng.random() < self.error_rate
+        return delay, fail
+
+
+def image_size(data):
+    """Width and height of the posted image, or a 640x640 guess without PIL"""
+    if Image is None:
+        return 640, 640
+    try:
+        return Image.open(io.BytesIO(data)).size
+    except Exception:
+        return 640, 640
+
+
+def fake_predictions(data, settings):
+    """Deterministic predictions for one image"""
+    rng = random.Random(f"{settings.seed}:{hashlib.sha256(data).hexdigest()}")
+    width, height = image_size(data)
+    if rng.random() < settings.empty_rate:
+        return width, height, []
+
+    predictions = []
+    for _ in range(rng.randint(1, settings.max_predictions)):
+        box_w = rng.uniform(0.05, 0.4) * width
+        box_h = rng.uniform(0.05, 0.4) * height
+        class_id = rng.randrange(len(CLASSES))
+        predictions.append({
+            "x": rng.uniform(box_w / 2, width - box_w / 2),
+            "y": rng.uniform(box_h / 2, height - box_h / 2),
+            "width": box_w,
+            "height": box_h,
+            "confidence": round(rng.uniform(0.3, 0.99), 4),
+            "class": CLASSES[class_id],
+            "class_id": class_id,
+            "detection_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        })
+    return width, height, predictions
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    settings = None
+
+    def log_message(self, format, *args):
+        # Keep benchmark output clean
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        # Health check used by the pooled client
+        self._send_json(200, {"status": "ok", "requests": self.settings.requests})
+
+    def do_POST(self):
+        started = time.time()
+        path = urlparse(self.path).path.strip("/")
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path.count("/") != 1:
+            self._send_json(404, {"message": f"Unknown model: {path}"})
+            return
+        try:
+            data = base64.b64decode(body, validate=False)
+        except ValueError:
+            self._send_json(400, {"message": "Body must be a base64 image"})
+            return
+
+        delay, fail = self.settings.next_delay_and_error()
+        time.sleep(delay)
+        if fail:
+            self._send_json(503, {"message": "Injected failure"})
+            return
+
+        width, height, predictions = fake_predictions(data, self.settings)
+        body = {
+            "inference_id": str(uuid.uuid4()),
+            "time": time.time() - started,
+            "image": {"width": width, "height": height},
+            "predictions": predictions,
+        }
+        if self.settings.padding:
+            # Inflate the response to test how payload size affects the scan flow
+            body["padding"] = "x" * self.settings.padding
+        self._send_json(200, body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Palay Protector inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--mean", type=float, default=0.4, help="mean latency in seconds")
+    parser.add_argument("--spread", type=float, default=0.5,
+                        help="half-width for uniform, sigma for lognormal")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--max-predictions", type=int, default=3, help="upper bound on boxes per image")
+    parser.add_argument("--empty-rate", type=float, default=0.3, help="fraction of images with no detections")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes added to every response")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    MockHandler.settings = MockSettings(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    print(f"Mock inference server on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()